@@ -0,0 +1,62 @@
+# Encode/decode throughput of the telemetry wire formats for one spindle scrape (8 DI channels).
+# Run from pub/:  python -m bench.codec_bench [iterations]
+import sys
+import time
+from utils.message import TelemetryMessage
+from utils.message import Zone
+from utils.message import Machine
+from utils.message import MachineStage
+from utils.codec import encode_payload
+from utils.codec import decode_payload
+from utils.codec import JSON_CONTENT_TYPE
+from utils.codec import BINARY_CONTENT_TYPE
+
+
+def sample_scrape():
+    return [
+        TelemetryMessage(
+            timestamp=int(time.time()),
+            source_mac="74:fe:48:6c:20:df",
+            source_ip="192.168.0.14",
+            source_name="Ironer 1",
+            zone=Zone.FINISHING,
+            machine=Machine.IRONER1,
+            machine_stage=MachineStage.STACKER,
+            value=123456 + index,
+            data_field_index=index,
+        )
+        for index in range(8)
+    ]
+
+
+def bench(name, content_type, batch, messages, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        payloads = encode_payload(messages, content_type, batch=batch)
+    encode_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for payload in payloads:
+            decode_payload(payload, content_type)
+    decode_seconds = time.perf_counter() - start
+
+    assert [m for p in payloads for m in decode_payload(p, content_type)] == messages
+    n = iterations * len(messages)
+    size = sum(len(p) for p in payloads)
+    print(f"{name:<14} {n / encode_seconds:>12,.0f} {n / decode_seconds:>12,.0f} {len(payloads):>9} {size:>11}")
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    messages = sample_scrape()
+    print(f"{iterations} scrapes of {len(messages)} channels")
+    print(f"{'format':<14} {'encode msg/s':>12} {'decode msg/s':>12} {'payloads':>9} {'bytes/scrape':>11}")
+    bench("json", JSON_CONTENT_TYPE, False, messages, iterations)
+    bench("json batch", JSON_CONTENT_TYPE, True, messages, iterations)
+    bench("binary", BINARY_CONTENT_TYPE, False, messages, iterations)
+    bench("binary batch", BINARY_CONTENT_TYPE, True, messages, iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,8 @@ from sqlalchemy import pool
 
 from db.model import device
 from db.model import message_info_config
+from db.model import device_fingerprint
+from db.model import table_version
 from db.model.base import Base
 from alembic import context
 
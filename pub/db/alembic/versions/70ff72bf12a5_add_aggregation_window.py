@@ -0,0 +1,32 @@
+"""add aggregation window
+
+Revision ID: 70ff72bf12a5
+Revises: 69002011e4a7
+Create Date: 2026-10-18 09:12:40.118203
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '70ff72bf12a5'
+down_revision: Union[str, Sequence[str], None] = '69002011e4a7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('devices', sa.Column('aggregation_window', sa.Integer(), nullable=True))
+    op.add_column('message_info_config', sa.Column('aggregation_window', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('message_info_config') as batch_op:
+        batch_op.drop_column('aggregation_window')
+    with op.batch_alter_table('devices') as batch_op:
+        batch_op.drop_column('aggregation_window')
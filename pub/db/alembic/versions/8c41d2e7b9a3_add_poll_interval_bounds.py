@@ -0,0 +1,31 @@
+"""add poll interval bounds
+
+Revision ID: 8c41d2e7b9a3
+Revises: 70ff72bf12a5
+Create Date: 2026-10-18 15:04:21.530117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8c41d2e7b9a3'
+down_revision: Union[str, Sequence[str], None] = '70ff72bf12a5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('message_info_config', sa.Column('min_poll_interval', sa.Integer(), nullable=True))
+    op.add_column('message_info_config', sa.Column('max_poll_interval', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('message_info_config') as batch_op:
+        batch_op.drop_column('max_poll_interval')
+        batch_op.drop_column('min_poll_interval')
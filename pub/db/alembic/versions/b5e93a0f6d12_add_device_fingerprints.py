@@ -0,0 +1,37 @@
+"""add device fingerprints
+
+Revision ID: b5e93a0f6d12
+Revises: 8c41d2e7b9a3
+Create Date: 2026-10-18 15:21:09.774512
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b5e93a0f6d12'
+down_revision: Union[str, Sequence[str], None] = '8c41d2e7b9a3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('device_fingerprints',
+    sa.Column('fingerprint', sa.String(), nullable=False),
+    sa.Column('auth_flow', sa.String(), nullable=False),
+    sa.Column('scraper', sa.String(), nullable=False),
+    sa.Column('username', sa.String(), nullable=True),
+    sa.Column('password', sa.String(), nullable=True),
+    sa.Column('successes', sa.Integer(), nullable=True),
+    sa.Column('last_success', sa.BigInteger(), nullable=True),
+    sa.PrimaryKeyConstraint('fingerprint')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('device_fingerprints')
@@ -0,0 +1,47 @@
+"""add table versions
+
+Revision ID: c3f1a7d2e8b4
+Revises: b5e93a0f6d12
+Create Date: 2026-10-18 15:24:51.203117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c3f1a7d2e8b4'
+down_revision: Union[str, Sequence[str], None] = 'b5e93a0f6d12'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# the MessageInfoConfigCache compares this version to skip reloads, sqlite's PRAGMA data_version
+# changes on every commit to the file (devices table included) so it can't tell
+TRIGGER_EVENTS = ['insert', 'update', 'delete']
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('table_versions',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.execute("INSERT INTO table_versions (name, version) VALUES ('message_info_config', 0)")
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for event in TRIGGER_EVENTS:
+        op.execute(
+            f"CREATE TRIGGER message_info_config_version_{event} AFTER {event.upper()} ON message_info_config "
+            f"BEGIN UPDATE table_versions SET version = version + 1 WHERE name = 'message_info_config'; END"
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name == 'sqlite':
+        for event in TRIGGER_EVENTS:
+            op.execute(f"DROP TRIGGER IF EXISTS message_info_config_version_{event}")
+    op.drop_table('table_versions')
@@ -16,4 +16,5 @@ class Device(Base):
     scraper = Column(String)
     last_data = Column(Text)
     last_seen = Column(BigInteger)  # Unix timestamp
+    aggregation_window = Column(Integer)  # seconds, publish summed deltas instead of every poll
 
@@ -0,0 +1,13 @@
+from sqlalchemy import Column, String, Integer, BigInteger
+from db.model.base import Base
+
+class DeviceFingerprint(Base):
+    __tablename__ = 'device_fingerprints'
+
+    fingerprint = Column(String, primary_key=True)  # oui|server banner|login page shape, see device/utils/fingerprint.py
+    auth_flow = Column(String, nullable=False)
+    scraper = Column(String, nullable=False)
+    username = Column(String)
+    password = Column(String)
+    successes = Column(Integer, default=0)  # devices onboarded with this mapping
+    last_success = Column(BigInteger)  # Unix timestamp
@@ -16,6 +16,9 @@ class MessageInfoConfig(Base):
     pieces = Column(Integer)
     estimated_pieces = Column(Integer)
     rfid = Column(String)
+    aggregation_window = Column(Integer)  # seconds, overrides devices.aggregation_window for this channel
+    min_poll_interval = Column(Integer)  # seconds, adaptive polling never goes faster than this
+    max_poll_interval = Column(Integer)  # seconds, adaptive polling never backs off further than this
 
     __table_args__ = (
         PrimaryKeyConstraint('mac', 'data_field_index'),
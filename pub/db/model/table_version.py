@@ -0,0 +1,8 @@
+from sqlalchemy import Column, String, BigInteger
+from db.model.base import Base
+
+class TableVersion(Base):
+    __tablename__ = 'table_versions'
+
+    name = Column(String, primary_key=True)  # table whose writes bump version
+    version = Column(BigInteger, nullable=False, default=0)  # bumped by triggers on every insert / update / delete
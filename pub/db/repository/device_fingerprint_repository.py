@@ -0,0 +1,29 @@
+from db.model.device_fingerprint import DeviceFingerprint
+from utils.logging import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class DeviceFingerprintRepository:
+    def __init__(self, session):
+        self.session = session
+
+    def get_all(self):
+        return self.session.query(DeviceFingerprint).all()
+
+    def get_by_fingerprint(self, fingerprint):
+        return self.session.query(DeviceFingerprint).filter_by(fingerprint=fingerprint).first()
+
+    def record_success(self, fingerprint, auth_flow, scraper, username, password, timestamp):
+        row = self.get_by_fingerprint(fingerprint)
+        if row is None:
+            row = DeviceFingerprint(fingerprint=fingerprint, successes=0)
+            self.session.add(row)
+        row.auth_flow = auth_flow
+        row.scraper = scraper
+        row.username = username
+        row.password = password
+        row.successes = (row.successes or 0) + 1
+        row.last_success = timestamp
+        self.session.commit()
+        return row
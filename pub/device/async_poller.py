@@ -0,0 +1,70 @@
+#device/async_poller.py
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from utils.logging import setup_logger
+
+logger = setup_logger(__name__)
+
+# Runs every device's poll cycle as a coroutine on the MessageBroker's event loop instead of
+# one OS thread per device. The auth flows and scrapers registered in auth_flow_registry and
+# scraper_registry are plain blocking functions, so the blocking part of a cycle runs on a
+# small shared executor, the semaphore caps how many of those are in flight at once and
+# the resulting messages are put straight onto the broker queue from the loop thread.
+class AsyncDevicePoller:
+    def __init__(self, config, loop):
+        self.loop = loop
+        self.max_concurrency = config.get("async_max_concurrency", 64)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="device-poll")
+        self.semaphore = None
+        self.tasks = {}  # type: dict[str, asyncio.Task]
+
+    def start_device(self, worker):
+        # Safe to call from any thread
+        asyncio.run_coroutine_threadsafe(self._start_device(worker), self.loop)
+
+    def stop_device(self, worker):
+        # Safe to call from any thread, blocks until the device's coroutine has finished
+        worker.stop()
+        future = asyncio.run_coroutine_threadsafe(self._stop_device(worker), self.loop)
+        future.result()
+
+    def stop(self):
+        for task in list(self.tasks.values()):
+            self.loop.call_soon_threadsafe(task.cancel)
+        self.executor.shutdown(wait=False)
+
+    async def _start_device(self, worker):
+        if self.semaphore is None:
+            # created lazily so it is bound to the broker loop
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        mac = worker.device.get("mac", "unknown")
+        if mac in self.tasks and not self.tasks[mac].done():
+            return
+        self.tasks[mac] = asyncio.create_task(self._run_device(worker))
+
+    async def _stop_device(self, worker):
+        mac = worker.device.get("mac", "unknown")
+        task = self.tasks.pop(mac, None)
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.loop.run_in_executor(self.executor, worker.close_session)
+
+    async def _run_device(self, worker):
+        mac = worker.device.get("mac", "unknown")
+        logger.info(f"Starting async poller for device {mac}")
+        while worker.running:
+            async with self.semaphore:
+                messages = await self.loop.run_in_executor(self.executor, worker.poll_once)
+            try:
+                worker.publish_messages(messages)
+            except Exception as e:
+                # counts against the device like a failed poll, the task keeps running
+                logger.error(f"Device {mac} failed to publish: {e}")
+                await self.loop.run_in_executor(self.executor, worker.record_failure)
+            await asyncio.sleep(worker.poll_interval)
+        await self.loop.run_in_executor(self.executor, worker.close_session)
+        logger.debug(f"Async poller stopping for device {mac}")
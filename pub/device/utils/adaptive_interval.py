@@ -0,0 +1,33 @@
+# Adaptive polling: shortens a device's poll interval while its counters are moving and backs it off
+# toward a ceiling while they sit still, so HTTP and CPU time goes to the machines that are producing.
+# The interval moves multiplicatively (speedup on a change, backoff when idle) and always stays
+# between the bounds, which can be narrowed per channel in message_info_config.
+
+from typing import List, Optional
+
+
+class AdaptiveInterval:
+    def __init__(self, interval: float, min_interval: float = 1, max_interval: float = 60,
+                 speedup: float = 0.5, backoff: float = 1.25):
+        if not 0 < speedup <= 1 or backoff < 1:
+            raise ValueError("speedup must be in (0, 1] and backoff at least 1")
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.speedup = speedup
+        self.backoff = backoff
+        self._last_data = None
+
+    def observe(self, data: List, min_interval: Optional[float] = None, max_interval: Optional[float] = None) -> float:
+        # Feeds one scrape and returns the interval to wait before the next one
+        lo = self.min_interval if min_interval is None else min_interval
+        hi = self.max_interval if max_interval is None else max_interval
+        lo = min(lo, hi)
+        if self._last_data is not None:
+            if data != self._last_data:
+                self.interval *= self.speedup
+            else:
+                self.interval *= self.backoff
+        self._last_data = list(data)
+        self.interval = max(lo, min(hi, self.interval))
+        return self.interval
@@ -1,8 +1,15 @@
 # This file uses decorators
 # @decorator is shorthand for func = decorator(func)
 # @register_auth_flow("spindle_device") register an auth flow function under a string key
+# Auth flows are called as fn(device, session) where session is the device's pooled
+# requests.Session from device/utils/http_transport.py, or a throwaway one during credential
+# discovery (falls back to bare requests if None)
+# @register_auth_flow("name", parallel_safe=True) declares that several logins may run against one
+# device at the same time, credential discovery only tries those in parallel. Challenge-response
+# flows (spindle: GET a seed, POST its hash) are not, a second login can replace the seed.
 
 from typing import Callable
+from typing import Optional
 from bs4 import BeautifulSoup
 import requests
 import hashlib
@@ -11,16 +18,20 @@ from utils.logging import setup_logger
 logger = setup_logger(__name__)
 
 auth_flow_registry: dict[str, Callable] = {}
+parallel_safe_auth_flows: set[str] = set()
 
 # helper function to add function to the auth flow registry
-def register_auth_flow(name: str):
+def register_auth_flow(name: str, parallel_safe: bool = False):
     def wrapper(func: Callable):
         auth_flow_registry[name] = func
+        if parallel_safe:
+            parallel_safe_auth_flows.add(name)
         return func
     return wrapper
 
 @register_auth_flow("spindle_device")
-def auth_spindle_device(device: dict) -> str:
+def auth_spindle_device(device: dict, session: Optional[requests.Session] = None) -> str:
+    http = session if session is not None else requests
     username = device['username']
     password = device['password']
     # username="root"
@@ -29,7 +40,7 @@ def auth_spindle_device(device: dict) -> str:
     #password="10011230"
     url = f"http://{ip}/config"
     hash_output = ""
-    response = requests.get(url)
+    response = http.get(url)
     response.raise_for_status() # Raises an error if the status code isn't 200
     content_type = response.headers.get("Content-Type", "")
     html_response = response.text
@@ -55,7 +66,7 @@ def auth_spindle_device(device: dict) -> str:
         headers = {
             "Content-Type": "application/x-www-form-urlencoded"
         }
-        response = requests.post(login_url, data=data, headers=headers)
+        response = http.post(login_url, data=data, headers=headers)
         response.raise_for_status() # Raises an error if the status code isn't 200
         content_type = response.headers.get("Content-Type", "")
         html_response = response.text
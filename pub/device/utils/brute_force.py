@@ -1,69 +1,183 @@
+# Credential discovery for devices that have no working login yet.
+# Every (credential, auth_flow) pair is a candidate. Candidates for one device run concurrently, at
+# most per_device_concurrency at a time, on a process wide pool whose size is the global limit, so a
+# first deployment with many devices doesn't take hours but also doesn't flood the controllers.
+# Only auth flows registered as parallel_safe share a device with other candidates, the rest run
+# alone. Every candidate uses its own throwaway http session, not the device's pooled one.
+# The first candidate that logs in and finds a working scraper wins and the rest are never started.
+# Candidates that worked on other devices are tried first since a site tends to share credentials.
+# With a FingerprintStore, a device whose fingerprint was seen before skips all that and gets one
+# targeted attempt with the mapping that worked last time; the sweep is only the fallback.
+
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Optional
 from device.utils.auth_flow_registry import auth_flow_registry
+from device.utils.auth_flow_registry import parallel_safe_auth_flows
 from device.utils.scraper_registry import scraper_registry
+from device.utils.http_transport import get_transport
+from device.utils.fingerprint import FingerprintStore
+from device.utils.fingerprint import KnownDeviceType
 from utils.logging import setup_logger
-from config import load_config
+from utils import metrics
 
 logger = setup_logger(__name__)
 
-def brute_force(device: dict) -> bool:
-    config = load_config()
-    password = None
-    username = None
-    auth_flow = None
-    scraper = None
-    cookie = None
-    for cred in config.get("credentials", []):
-        try: 
-            device['password'] = cred['password']
-            device['username'] = cred['username']
-            password, username, auth_flow, scraper, cookie = check_credentials(device, cred['password'], cred['username'])
-            if password is not None and username is not None and auth_flow is not None and scraper is not None:
-                break
-        except Exception as e:
-            continue
-    return [password, username, auth_flow, scraper, cookie]
-
-def check_credentials(device, password, username):
-    logger.info(f"Brute forcing device {device.get('mac')}")
-    auth_flow = None
-    scraper = None
-    # check if auth flow throws error
-    auth_flow, cookie = test_against_auth_flows(device, password, username)
-    if auth_flow is not None:
-        # if auth flow works, check if scraper works
-        scraper = test_against_scrapers(device, password, username, cookie)
-
-    logger.info(f"Brute force credential discovery found {password}, {username}, {auth_flow}, {scraper}")
-    return [password, username, auth_flow, scraper, cookie]
-
-
-def test_against_auth_flows(device, password, username):
-    auth_flow = None
-    successfully_retrieved_cookie = None
-    for key, auth_flow_fn in auth_flow_registry.items():
+
+class CredentialDiscovery:
+    def __init__(self, config: dict, fingerprints: Optional[FingerprintStore] = None):
+        if not isinstance(config, dict):
+            raise TypeError(f"Expected config to be dict, got {type(config).__name__}")
+        discovery_config = config.get("discovery", {})
+        # parsed once here instead of re-reading config.yaml for every device
+        self.credentials = [(cred["username"], cred["password"]) for cred in config.get("credentials", [])]
+        self.per_device_concurrency = discovery_config.get("per_device_concurrency", 1)
+        self.global_concurrency = discovery_config.get("global_concurrency", 16)
+        self.executor = ThreadPoolExecutor(max_workers=self.global_concurrency, thread_name_prefix="discovery")
+        self._hits = Counter()  # key: (username, password, auth_flow), value: devices it worked on
+        self._lock = threading.Lock()
+        self.fingerprints = fingerprints
+
+    def candidates(self):
+        candidates = [
+            (username, password, auth_flow)
+            for username, password in self.credentials
+            for auth_flow in auth_flow_registry
+        ]
+        with self._lock:
+            hits = dict(self._hits)
+        # stable sort keeps the configured order between candidates with the same number of hits
+        return sorted(candidates, key=lambda candidate: -hits.get(candidate, 0))
+
+    def discover(self, device: dict):
+        # Returns [password, username, auth_flow, scraper, cookie], all None when nothing worked
+        mac = device.get("mac")
+        started = time.monotonic()
+        fingerprint = None
+        result = None
+        if self.fingerprints is not None:
+            fingerprint = self.fingerprints.fingerprint(device)
+            result = self.try_known_type(device, fingerprint)
+        if result is None:
+            result = self.sweep(device)
+        elapsed = time.monotonic() - started
+        if result is None:
+            logger.warning(f"Credential discovery for {mac} found nothing after {elapsed:.2f}s")
+            return [None, None, None, None, None]
+        username, password, auth_flow, scraper, cookie = result
+        with self._lock:
+            self._hits[(username, password, auth_flow)] += 1
+        if self.fingerprints is not None:
+            self.fingerprints.learn(fingerprint, KnownDeviceType(auth_flow, scraper, username, password))
+        logger.info(f"Credential discovery for {mac} found {username}, {auth_flow}, {scraper} in {elapsed:.2f}s")
+        return [password, username, auth_flow, scraper, cookie]
+
+    def try_known_type(self, device: dict, fingerprint: Optional[str]):
+        known = self.fingerprints.lookup(fingerprint)
+        if known is None or known.auth_flow not in auth_flow_registry:
+            metrics.discovery_fingerprints_total.labels(result="miss").inc()
+            return None
+        candidate = (known.username, known.password, known.auth_flow)
+        result = self.try_candidate(device, candidate, threading.Event(), preferred_scraper=known.scraper)
+        if result is None:
+            # firmware update or changed password, learn again from the sweep
+            logger.info(f"Known device type {fingerprint} did not work for {device.get('mac')}, falling back to a full sweep")
+            metrics.discovery_fingerprints_total.labels(result="stale").inc()
+            return None
+        metrics.discovery_fingerprints_total.labels(result="hit").inc()
+        return result
+
+    def sweep(self, device: dict):
+        pending = self.candidates()
+        cancelled = threading.Event()
+        in_flight = {}  # key: future, value: candidate
+        result = None
         try:
-            successfully_retrieved_cookie = auth_flow_fn(device)
-            logger.info(f"Brute force successfully retrieved cookie {successfully_retrieved_cookie} using {password} {username} {key}")
-            auth_flow = key
-            if successfully_retrieved_cookie is not None:
-                break
-        except Exception as e:
-            continue
-    return [auth_flow, successfully_retrieved_cookie]
+            while True:
+                while pending and len(in_flight) < self.per_device_concurrency and self.can_start(pending[0], in_flight.values()):
+                    candidate = pending.pop(0)
+                    in_flight[self.executor.submit(self.try_candidate, device, candidate, cancelled)] = candidate
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    in_flight.pop(future)
+                    if result is None and future.result() is not None:
+                        result = future.result()
+                if result is not None:
+                    break
+        finally:
+            # candidates already talking to the device finish their request and are discarded,
+            # the ones that haven't started yet return immediately
+            cancelled.set()
+            for future in in_flight:
+                future.cancel()
+        return result
+
+    def can_start(self, candidate, running) -> bool:
+        # a flow that isn't parallel safe waits until the device is free, and keeps it to itself
+        running = list(running)
+        if not running:
+            return True
+        return candidate[2] in parallel_safe_auth_flows and all(other[2] in parallel_safe_auth_flows for other in running)
 
-def test_against_scrapers(device, password, username, cookie):
-    scraper = None
-    successfully_retrieved_data = None
-    for key, scraper_fn in scraper_registry.items():
+    def try_candidate(self, device: dict, candidate, cancelled: threading.Event, preferred_scraper: Optional[str] = None):
+        if cancelled.is_set():
+            return None
+        username, password, auth_flow = candidate
+        # every candidate works on its own copy, they run at the same time against one device
+        device = dict(device, username=username, password=password)
+        started = time.monotonic()
+        outcome = "failed"
         try:
-            device['cookie'] = cookie
-            successfully_retrieved_data = scraper_fn(device)
-            logger.info(f"Brute force successfully scraped {successfully_retrieved_data} using {password} {username} {key}")
-            scraper = key
-            if successfully_retrieved_data is not None:
-                break
+            cookie = get_transport().call("login", device, auth_flow_registry[auth_flow], isolated=True)
+            if cookie is None or cancelled.is_set():
+                return None
+            device["cookie"] = cookie
+            scraper = self.find_scraper(device, preferred_scraper)
+            if scraper is None:
+                return None
+            outcome = "success"
+            return username, password, auth_flow, scraper, cookie
         except Exception as e:
-            continue
-    return scraper
+            logger.debug(f"Candidate {username}/{auth_flow} failed for {device.get('mac')}: {e}")
+            return None
+        finally:
+            elapsed = time.monotonic() - started
+            metrics.discovery_attempt_seconds.labels(outcome=outcome).observe(elapsed)
+            logger.debug(f"Candidate {username}/{auth_flow} for {device.get('mac')}: {outcome} in {elapsed:.3f}s")
+
+    def find_scraper(self, device: dict, preferred: Optional[str] = None) -> Optional[str]:
+        keys = list(scraper_registry)
+        if preferred in scraper_registry:
+            keys.remove(preferred)
+            keys.insert(0, preferred)
+        for key in keys:
+            scraper_fn = scraper_registry[key]
+            try:
+                if get_transport().call("scrape", device, scraper_fn, isolated=True) is not None:
+                    return key
+            except Exception as e:
+                logger.debug(f"Scraper {key} failed for {device.get('mac')}: {e}")
+        return None
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def brute_force(device: dict):
+    return get_discovery().discover(device)
+
+# This handles the singleton situation
+def set_discovery(instance: CredentialDiscovery):
+    global discovery
+    discovery = instance
 
+def get_discovery() -> CredentialDiscovery:
+    if discovery is None:
+        raise RuntimeError("CredentialDiscovery has not been initialized yet. Call set_discovery() first.")
+    return discovery
 
+discovery: Optional[CredentialDiscovery] = None
@@ -0,0 +1,31 @@
+# Change-only publishing: remembers the last published value per (mac, data_field_index) and only
+# lets a reading through when it differs. Every keyframe_interval seconds everything is let through
+# once so a consumer that lost state (restart, purged stream) can resynchronize.
+
+import time
+from typing import List
+from utils.message import TelemetryMessage
+
+
+class ChangeFilter:
+    def __init__(self, keyframe_interval: int = 300):
+        self.keyframe_interval = keyframe_interval
+        self._last_published = {}  # key: (mac, data_field_index), value: last published value
+        self._next_keyframe = 0
+
+    def filter(self, messages: List[TelemetryMessage], now: float = None) -> List[TelemetryMessage]:
+        now = time.time() if now is None else now
+        if now >= self._next_keyframe:
+            self._next_keyframe = now + self.keyframe_interval
+            changed = messages
+        else:
+            changed = [
+                msg for msg in messages
+                if self._last_published.get((msg.source_mac, msg.data_field_index)) != msg.value
+            ]
+        for msg in changed:
+            self._last_published[(msg.source_mac, msg.data_field_index)] = msg.value
+        return changed
+
+    def force_keyframe(self):
+        self._next_keyframe = 0
@@ -0,0 +1,111 @@
+# Per-device circuit breaker. A device that keeps failing is quarantined (OPEN) instead of being
+# polled on its normal cadence: its worker is stopped so it holds no thread or socket, and it is only
+# tried again after an exponentially growing, jittered backoff. The retry is a single HALF_OPEN probe,
+# success closes the breaker, failure re-opens it with a doubled backoff. A shared ProbeBudget caps how
+# many quarantined devices are probed at the same time so a recheck never starts them all at once.
+
+import random
+import threading
+import time
+from enum import Enum
+
+
+class BreakerState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class ProbeBudget:
+    def __init__(self, max_concurrent_probes: int = 4):
+        self.max_concurrent_probes = max_concurrent_probes
+        self.in_use = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.in_use >= self.max_concurrent_probes:
+                return False
+            self.in_use += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_use = max(0, self.in_use - 1)
+
+
+class CircuitBreaker:
+    def __init__(self, budget: ProbeBudget, failure_threshold: int = 5, base_backoff: float = 30,
+                 max_backoff: float = 3600, jitter: float = 0.2):
+        self.budget = budget
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.state = BreakerState.CLOSED
+        self.failures = 0  # consecutive failures while closed
+        self.trips = 0  # consecutive times the breaker opened without a successful poll in between
+        self.next_probe = 0.0
+        self._lock = threading.Lock()
+
+    def record_success(self) -> bool:
+        # Returns True when this success ended a quarantine
+        with self._lock:
+            recovered = self.state == BreakerState.HALF_OPEN
+            if recovered:
+                self.budget.release()
+            self.state = BreakerState.CLOSED
+            self.failures = 0
+            self.trips = 0
+            return recovered
+
+    def record_failure(self, now: float = None) -> bool:
+        # Returns True when the breaker (re)opened and the device should be quarantined
+        with self._lock:
+            if self.state == BreakerState.HALF_OPEN:
+                self.budget.release()
+                self._open(now)
+                return True
+            if self.state == BreakerState.OPEN:
+                return True
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self._open(now)
+                return True
+            return False
+
+    def quarantine(self, now: float = None):
+        # Opens the breaker for a device that is already known to be bad, e.g. loaded invalid at startup
+        with self._lock:
+            if self.state == BreakerState.CLOSED:
+                self._open(now)
+
+    def _open(self, now: float = None):
+        now = time.monotonic() if now is None else now
+        self.trips += 1
+        backoff = min(self.max_backoff, self.base_backoff * 2 ** (self.trips - 1))
+        backoff *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        self.state = BreakerState.OPEN
+        self.failures = 0
+        self.next_probe = now + backoff
+
+    def try_probe(self, now: float = None) -> bool:
+        # OPEN -> HALF_OPEN once the backoff has passed and the global budget has room
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self.state != BreakerState.OPEN or now < self.next_probe:
+                return False
+            if not self.budget.try_acquire():
+                return False
+            self.state = BreakerState.HALF_OPEN
+            return True
+
+    def abandon_probe(self, now: float = None):
+        # The probing worker was stopped before it reported back (ip change, shutdown), retry
+        # later without counting it as another failure
+        with self._lock:
+            if self.state != BreakerState.HALF_OPEN:
+                return
+            self.budget.release()
+            self.state = BreakerState.OPEN
+            self.next_probe = time.monotonic() if now is None else now
@@ -0,0 +1,104 @@
+# Device fingerprinting, so a new device of a type we've already onboarded gets one targeted login
+# attempt instead of a full credential discovery sweep.
+# A fingerprint is built from cheap signals: the MAC OUI (vendor prefix), the HTTP Server banner and
+# the shape of the page served at fingerprint.probe_path (title and sorted form input names).
+# FingerprintStore keeps the learned fingerprint -> (auth_flow, scraper, credential) mapping in the
+# device_fingerprints table and in memory; lookups never touch the database.
+
+import hashlib
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+from bs4 import BeautifulSoup
+from db.utils.db_session import SessionLocal
+from db.repository.device_fingerprint_repository import DeviceFingerprintRepository
+from device.utils.http_transport import get_transport
+from utils.logging import setup_logger
+
+logger = setup_logger(__name__)
+
+
+@dataclass(frozen=True)
+class KnownDeviceType:
+    auth_flow: str
+    scraper: str
+    username: Optional[str]
+    password: Optional[str]
+
+
+def mac_oui(mac: str) -> str:
+    return mac.upper().replace("-", ":")[:8]
+
+
+def page_shape(html: str) -> str:
+    # Short hash of what the login page looks like, stable across devices of the same model
+    soup = BeautifulSoup(html, "html.parser")
+    title = soup.title.string.strip() if soup.title and soup.title.string else ""
+    inputs = sorted(tag.get("name", "") for tag in soup.find_all("input"))
+    shape = f"{title}|{','.join(inputs)}"
+    return hashlib.sha1(shape.encode("utf-8")).hexdigest()[:12]
+
+
+class FingerprintStore:
+    def __init__(self, config: dict):
+        if not isinstance(config, dict):
+            raise TypeError(f"Expected config to be dict, got {type(config).__name__}")
+        fingerprint_config = config.get("fingerprint", {})
+        self.enabled = fingerprint_config.get("enabled", True)
+        self.probe_path = fingerprint_config.get("probe_path", "/")
+        self._known = {}  # key: fingerprint, value: KnownDeviceType
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        session = SessionLocal()
+        try:
+            rows = DeviceFingerprintRepository(session).get_all()
+            self._known = {
+                row.fingerprint: KnownDeviceType(row.auth_flow, row.scraper, row.username, row.password)
+                for row in rows
+            }
+            logger.info(f"Loaded {len(self._known)} device fingerprints")
+        except Exception as e:
+            logger.error(f"Failed to load device fingerprints: {e}")
+        finally:
+            session.close()
+
+    def fingerprint(self, device: dict) -> Optional[str]:
+        # Returns None when the device couldn't be probed, the caller falls back to a full sweep
+        if not self.enabled:
+            return None
+        try:
+            response = get_transport().call("fingerprint", device, self._probe)
+        except Exception as e:
+            logger.debug(f"Could not fingerprint {device.get('mac')}: {e}")
+            return None
+        server = response.headers.get("Server", "")
+        return f"{mac_oui(device['mac'])}|{server}|{page_shape(response.text)}"
+
+    def _probe(self, device: dict, session):
+        return session.get(f"http://{device['ip']}{self.probe_path}")
+
+    def lookup(self, fingerprint: Optional[str]) -> Optional[KnownDeviceType]:
+        if fingerprint is None:
+            return None
+        return self._known.get(fingerprint)
+
+    def learn(self, fingerprint: Optional[str], known: KnownDeviceType):
+        if fingerprint is None:
+            return
+        with self._lock:
+            # the dict is only replaced, never modified, so lookup stays lock free
+            self._known = {**self._known, fingerprint: known}
+        session = SessionLocal()
+        try:
+            DeviceFingerprintRepository(session).record_success(
+                fingerprint, known.auth_flow, known.scraper, known.username, known.password, int(time.time())
+            )
+            logger.info(f"Learned device type {fingerprint} -> {known.auth_flow}, {known.scraper}")
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Failed to persist device fingerprint {fingerprint}: {e}")
+        finally:
+            session.close()
@@ -0,0 +1,196 @@
+# Shared HTTP transport for the auth flows and scrapers.
+# Every device gets its own requests.Session so polls reuse a warm keep-alive socket instead
+# of opening a new TCP connection each time, and every request gets a connect/read timeout.
+# Device operations (login, scrape) go through HttpTransport.call which puts the whole operation,
+# every request it makes, under one deadline from config so a hung controller can't pin a worker.
+
+import threading
+import time
+from http import cookiejar
+from typing import Optional
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError
+from urllib3.exceptions import ReadTimeoutError
+from utils.logging import setup_logger
+from utils import metrics
+
+logger = setup_logger(__name__)
+
+CHUNK_SIZE = 8192
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class BlockAllCookies(cookiejar.CookiePolicy):
+    # Cookies are managed explicitly by the auth flows (device['cookie']), so the session jar
+    # must not replay a stale login cookie from a previous attempt. response.cookies still works.
+    netscape = True
+    rfc2965 = hide_cookie2 = False
+
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+    def domain_return_ok(self, domain, request):
+        return False
+
+    def path_return_ok(self, path, request):
+        return False
+
+
+class TimeoutSession(requests.Session):
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+        self.cookies.set_policy(BlockAllCookies())
+        self._local = threading.local()  # deadline of the operation running on this thread
+
+    def set_deadline(self, deadline: Optional[float]):
+        self._local.deadline = deadline
+
+    def get_deadline(self) -> Optional[float]:
+        return getattr(self._local, "deadline", None)
+
+    def request(self, method, url, **kwargs):
+        deadline = self.get_deadline()
+        if deadline is None:
+            kwargs.setdefault("timeout", self.timeout)
+            return super().request(method, url, **kwargs)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"Deadline passed before {method} {url}")
+        connect_timeout, read_timeout = self.timeout
+        kwargs["timeout"] = (min(connect_timeout, remaining), min(read_timeout, remaining))
+        kwargs["stream"] = True
+        try:
+            response = super().request(method, url, **kwargs)
+            # the read timeout is per recv, a device trickling bytes could still run forever,
+            # so the body is read here and checked against the deadline after every recv.
+            # read1 returns whatever one recv got instead of waiting for a full chunk, decoded since
+            # requests opens the raw response with decode_content=False (gzip replies)
+            chunks = []
+            while True:
+                chunk = response.raw.read1(CHUNK_SIZE, decode_content=True)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                if time.monotonic() > deadline:
+                    response.close()
+                    raise DeadlineExceeded(f"Deadline passed while reading {url}")
+            response._content = b"".join(chunks)
+            response._content_consumed = True
+            return response
+        except requests.exceptions.Timeout as e:
+            raise DeadlineExceeded(f"{method} {url} timed out: {e}") from e
+        except (ReadTimeoutError, ProtocolError) as e:
+            # raised by the raw body read above, requests only converts these for its own reads
+            raise DeadlineExceeded(f"{method} {url} stalled while reading the body: {e}") from e
+
+
+class HttpTransport:
+    def __init__(self, config: dict):
+        if not isinstance(config, dict):
+            raise TypeError(f"Expected config to be dict, got {type(config).__name__}")
+        http_config = config.get("http", {})
+        self.timeout = (http_config.get("connect_timeout", 3), http_config.get("read_timeout", 5))
+        self.pool_maxsize = http_config.get("pool_maxsize", 4)
+        # seconds allowed for a whole operation, keyed by operation name ("login", "scrape")
+        self.deadlines = http_config.get("deadlines", {})
+        self.default_deadline = sum(self.timeout)
+        # retry once on a fresh connection when a device misses its deadline. Sequential, so the
+        # worst case is twice the deadline
+        self.retry_on_deadline = http_config.get("retry_on_deadline", False)
+        # log operations that used more than this fraction of their deadline
+        self.slow_warning = http_config.get("slow_warning", 0.5)
+        self._sessions = {}  # key: mac, value: TimeoutSession
+        self._lock = threading.Lock()
+
+    def _new_session(self) -> TimeoutSession:
+        session = TimeoutSession(self.timeout)
+        # one pool per device, retries are handled by the worker not urllib3
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize, max_retries=0)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def session_for(self, device: dict) -> TimeoutSession:
+        key = device.get("mac") or device.get("ip")
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = self._new_session()
+                self._sessions[key] = session
+                logger.debug(f"Opened http session for {key}")
+            return session
+
+    def call(self, operation: str, device: dict, fn, isolated: bool = False):
+        # Runs fn(device, session) under the operation's deadline and records how long it took.
+        # isolated runs on a throwaway session instead of the device's pooled one, for callers that
+        # talk to one device from several threads at once (credential discovery)
+        mac = device.get("mac") or device.get("ip")
+        deadline = self.deadlines.get(operation, self.default_deadline)
+        attempts = 2 if self.retry_on_deadline else 1
+        for attempt in range(attempts):
+            session = self._new_session() if isolated else self.session_for(device)
+            started = time.monotonic()
+            session.set_deadline(started + deadline)
+            missed = False
+            try:
+                result = fn(device, session)
+            except DeadlineExceeded as e:
+                missed = True
+                # the stuck connection is dropped so the next attempt or poll opens a new one
+                if not isolated:
+                    self.close_session(mac)
+                if attempt + 1 == attempts:
+                    raise
+                logger.warning(f"{operation} for {mac} missed its {deadline}s deadline ({e}), retrying on a fresh connection")
+                metrics.device_deadline_retries_total.labels(operation=operation).inc()
+                continue
+            finally:
+                session.set_deadline(None)
+                if isolated:
+                    session.close()
+                # failed operations (refused, http errors) are recorded too, slow failures count
+                elapsed = time.monotonic() - started
+                self._record(operation, mac, elapsed, missed=missed)
+            if elapsed > deadline * self.slow_warning:
+                logger.warning(f"Slow {operation} for {mac}: {elapsed:.2f}s of a {deadline}s deadline")
+            return result
+
+    def _record(self, operation: str, mac: str, elapsed: float, missed: bool):
+        metrics.device_operation_seconds.labels(operation=operation).observe(elapsed)
+        metrics.device_operation_last_seconds.labels(mac=mac, operation=operation).set(elapsed)
+        if missed:
+            metrics.device_deadline_misses_total.labels(mac=mac, operation=operation).inc()
+
+    def close_session(self, mac: str):
+        with self._lock:
+            session = self._sessions.pop(mac, None)
+        if session is not None:
+            session.close()
+            logger.debug(f"Closed http session for {mac}")
+
+    def close(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions = {}
+        for session in sessions:
+            session.close()
+
+# This handles the singleton situation
+def set_transport(instance: HttpTransport):
+    global transport
+    transport = instance
+
+def get_transport() -> HttpTransport:
+    if transport is None:
+        raise RuntimeError("HttpTransport has not been initialized yet. Call set_transport() first.")
+    return transport
+
+transport: Optional[HttpTransport] = None
@@ -1,9 +1,20 @@
 # This file uses decorators
 # @decorator is shorthand for func = decorator(func)
 # @register_scraper("json_http") registers a scraping function under a string key
+# Scrapers are called as fn(device, session) where session is the device's pooled
+# requests.Session from device/utils/http_transport.py (falls back to bare requests if None)
+#
+# Controllers with more than one I/O slot describe their reads as a list of Endpoints instead of
+# doing one round trip per slot in sequence. fetch_endpoints requests them concurrently over the
+# device's pooled session and merges the results into one reading vector. Every endpoint owns a
+# fixed block of `width` indices, so data_field_index stays stable even if a slot returns fewer values.
+# The unused indices of a block are None, they are not readings and the worker skips them.
 
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from typing import List
 from typing import Callable
+from typing import Optional
 import json
 import requests
 from utils.logging import setup_logger
@@ -12,6 +23,9 @@ logger = setup_logger(__name__)
 
 scraper_registry: dict[str, Callable] = {}
 
+# shared by every device, a device only ever has as many fetches in flight as it has endpoints
+endpoint_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="endpoint-fetch")
+
 # helper function to add functions to the scraper registry
 def register_scraper(name: str):
     def wrapper(func: Callable):
@@ -19,23 +33,72 @@ def register_scraper(name: str):
         return func
     return wrapper
 
-@register_scraper("spindle_device")
-def scrape_from_spindle_device(device: dict) -> List[int]:
-    logger.info(f"Scraping device mac: {device.get('mac')}, ip: {device.get('ip')} with cookie: {device.get('cookie')}")
+
+@dataclass(frozen=True)
+class Endpoint:
+    path: str
+    width: int  # indices reserved for this endpoint in the merged readings
+    parse: Callable[[str], List[int]]
+
+
+def fetch_endpoints(device: dict, session: Optional[requests.Session], endpoints: List[Endpoint], headers: dict) -> List[Optional[int]]:
+    http = session if session is not None else requests
     ip = device["ip"]
-    cookie = device["cookie"]
-    device_data_readings = []
+    # the operation deadline lives in a thread local on the session, the fetch threads need it too
+    deadline = session.get_deadline() if hasattr(session, "get_deadline") else None
 
-    url = f'http://{ip}/di_value/slot_0'
-    logger.info(f"scraping {url}")
-    headers = {'Cookie': f'adamsessionid={cookie}'}
-    response = requests.get(url, headers=headers)
-    json_text = response.text
-    logger.info(f"{device.get('mac')} json returned during scraping: {json_text}")
+    def fetch(endpoint: Endpoint) -> List[int]:
+        url = f"http://{ip}{endpoint.path}"
+        logger.info(f"scraping {url}")
+        response = http.get(url, headers=headers)
+        response.raise_for_status() # a 401 makes the worker re-authenticate
+        logger.info(f"{device.get('mac')} json returned during scraping: {response.text}")
+        return endpoint.parse(response.text)
+
+    def fetch_in_thread(endpoint: Endpoint) -> List[int]:
+        if deadline is not None:
+            session.set_deadline(deadline)
+        try:
+            return fetch(endpoint)
+        finally:
+            if deadline is not None:
+                session.set_deadline(None)
+
+    if len(endpoints) == 1:
+        results = [fetch(endpoints[0])]  # no point handing a single read to another thread
+    else:
+        futures = [endpoint_executor.submit(fetch_in_thread, endpoint) for endpoint in endpoints]
+        results = [future.result() for future in futures]
+
+    readings = []
+    for position, (endpoint, values) in enumerate(zip(endpoints, results)):
+        if len(values) > endpoint.width:
+            logger.warning(f"{device.get('mac')} {endpoint.path} returned {len(values)} values, only {endpoint.width} are kept")
+            values = values[:endpoint.width]
+        readings.extend(values)
+        if position < len(endpoints) - 1:
+            # pad so the next endpoint still starts at its fixed base index
+            readings.extend([None] * (endpoint.width - len(values)))
+    return readings
+
+
+def parse_spindle_di_values(json_text: str) -> List[int]:
     parsed_data = json.loads(json_text)
     logger.info(f"parsed data from returned json: {parsed_data}")
-    di_val = parsed_data["DIVal"]
-    for val in di_val:
-        device_data_readings.append(val["Val"])
-    return device_data_readings
+    return [val["Val"] for val in parsed_data["DIVal"]]
+
+
+SPINDLE_SLOT_WIDTH = 16
+
+def spindle_endpoints(device: dict) -> List[Endpoint]:
+    # device["slots"] comes from device_overrides in config.yaml, most controllers only have slot 0
+    slots = device.get("slots") or [0]
+    return [Endpoint(f"/di_value/slot_{slot}", SPINDLE_SLOT_WIDTH, parse_spindle_di_values) for slot in slots]
 
+
+@register_scraper("spindle_device")
+def scrape_from_spindle_device(device: dict, session: Optional[requests.Session] = None) -> List[Optional[int]]:
+    logger.info(f"Scraping device mac: {device.get('mac')}, ip: {device.get('ip')} with cookie: {device.get('cookie')}")
+    cookie = device["cookie"]
+    headers = {'Cookie': f'adamsessionid={cookie}'}
+    return fetch_endpoints(device, session, spindle_endpoints(device), headers)
@@ -0,0 +1,164 @@
+# Keeps every device's login cookie fresh so polls never wait on a login handshake.
+# Each cookie is valid for cookie_ttl_seconds and gets re-logged in the background once only
+# refresh_ahead of its lifetime is left, minus a random jitter so devices that logged in together
+# don't all refresh together. Cookies are persisted to the devices table (cookie, cookie_expires)
+# through the registry and reloaded on startup, so a restart resumes the existing sessions.
+
+import heapq
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from device.utils.auth_flow_registry import auth_flow_registry
+from device.utils.http_transport import get_transport
+from master.device_registry import get_registry
+from utils.logging import setup_logger
+
+logger = setup_logger(__name__)
+
+AUTH_FAILURE_STATUSES = (401, 403)
+
+
+def is_auth_failure(exc: Exception) -> bool:
+    # requests.HTTPError from raise_for_status carries the response
+    response = getattr(exc, "response", None)
+    return getattr(response, "status_code", None) in AUTH_FAILURE_STATUSES
+
+
+class SessionManager(threading.Thread):
+    def __init__(self, config: dict):
+        super().__init__()
+        if not isinstance(config, dict):
+            raise TypeError(f"Expected config to be dict, got {type(config).__name__}")
+        session_config = config.get("sessions", {})
+        self.daemon = True
+        self.running = True
+        self.cookie_ttl = config.get("cookie_ttl_seconds", 1200)
+        self.refresh_ahead = session_config.get("refresh_ahead", 0.2)  # fraction of the ttl
+        self.jitter = session_config.get("jitter", 0.1)  # fraction of the ttl
+        self.retry_interval = session_config.get("retry_interval", 30)
+        self.executor = ThreadPoolExecutor(max_workers=session_config.get("refresh_workers", 4), thread_name_prefix="cookie-refresh")
+        self._sessions = {}  # key: mac, value: [device copy, cookie, expires (unix time), generation]
+        self._refreshes = []  # heap of (refresh at (unix time), mac, generation)
+        self._cond = threading.Condition()
+
+    def load_persisted(self, devices):
+        # resume sessions whose persisted cookie hasn't expired yet, invalid devices are never polled
+        now = time.time()
+        resumed = 0
+        with self._cond:
+            for device in devices:
+                if device.get("valid") and device.get("cookie") and device.get("auth_flow") and (device.get("cookie_expires") or 0) > now:
+                    self._set(dict(device), device["cookie"], device["cookie_expires"])
+                    resumed += 1
+        logger.info(f"Resumed {resumed} persisted device sessions")
+
+    def cookie_for(self, device: dict) -> Optional[str]:
+        # A valid cookie for the device, only logs in inline when there is none (first poll, or
+        # the background refresh kept failing until the cookie ran out)
+        with self._cond:
+            session = self._sessions.get(device.get("mac"))
+            if session is not None and session[2] > time.time():
+                return session[1]
+        return self.login(device)
+
+    def login(self, device: dict) -> Optional[str]:
+        auth_flow = device.get("auth_flow")
+        if auth_flow is None:
+            return None
+        cookie = get_transport().call("login", device, auth_flow_registry[auth_flow])
+        if cookie is not None:
+            self.store(device, cookie)
+        return cookie
+
+    def store(self, device: dict, cookie: str):
+        expires = int(time.time()) + self.cookie_ttl
+        with self._cond:
+            self._set(dict(device), cookie, expires)
+        get_registry().get_handle_to_update_device_field(device["mac"])(cookie=cookie, cookie_expires=expires)
+
+    def _set(self, device: dict, cookie: str, expires: int):
+        # caller holds self._cond
+        mac = device["mac"]
+        previous = self._sessions.get(mac)
+        generation = previous[3] + 1 if previous is not None else 0
+        self._sessions[mac] = [device, cookie, expires, generation]
+        refresh_at = expires - self.cookie_ttl * (self.refresh_ahead + random.uniform(0, self.jitter))
+        refresh_at = max(refresh_at, time.time() + 1)  # a nearly expired cookie must not refresh in a tight loop
+        self._schedule(refresh_at, mac, generation)
+
+    def _schedule(self, refresh_at: float, mac: str, generation: int):
+        heapq.heappush(self._refreshes, (refresh_at, mac, generation))
+        self._cond.notify()
+
+    def invalidate(self, mac: str):
+        # the device rejected the cookie (401/403), the next cookie_for logs in again
+        with self._cond:
+            session = self._sessions.get(mac)
+            if session is not None:
+                session[2] = 0
+
+    def forget(self, mac: str):
+        # worker stopped, stop refreshing its cookie. Stale heap entries are skipped by generation
+        with self._cond:
+            self._sessions.pop(mac, None)
+
+    def run(self):
+        logger.info("Session manager starting")
+        while self.running:
+            with self._cond:
+                while self.running and (not self._refreshes or self._refreshes[0][0] > time.time()):
+                    timeout = self._refreshes[0][0] - time.time() if self._refreshes else None
+                    self._cond.wait(timeout=timeout)
+                if not self.running:
+                    break
+                _, mac, generation = heapq.heappop(self._refreshes)
+                session = self._sessions.get(mac)
+                if session is None or session[3] != generation:
+                    continue
+                device = dict(session[0])
+            self.executor.submit(self._refresh, device, generation)
+
+    def _refresh(self, device: dict, generation: int):
+        mac = device["mac"]
+        try:
+            cookie = get_transport().call("login", device, auth_flow_registry[device["auth_flow"]])
+            if cookie is None:
+                raise ValueError("auth flow returned no cookie")
+            with self._cond:
+                session = self._sessions.get(mac)
+                if session is None or session[3] != generation:
+                    return  # forgotten or replaced while logging in
+            self.store(device, cookie)
+            logger.debug(f"Refreshed cookie for {mac}")
+        except Exception as e:
+            logger.error(f"Background cookie refresh for {mac} failed: {e}")
+            with self._cond:
+                session = self._sessions.get(mac)
+                if session is None or session[3] != generation:
+                    return
+                if session[2] > time.time():
+                    self._schedule(time.time() + self.retry_interval, mac, generation)
+                else:
+                    # the cookie ran out, stop retrying in the background. The next poll logs in
+                    # inline and a successful login schedules refreshes again
+                    self.forget(mac)
+
+    def stop(self):
+        self.running = False
+        with self._cond:
+            self._cond.notify()
+        self.executor.shutdown(wait=False)
+
+# This handles the singleton situation
+def set_session_manager(instance: SessionManager):
+    global session_manager
+    session_manager = instance
+
+def get_session_manager() -> SessionManager:
+    if session_manager is None:
+        raise RuntimeError("SessionManager has not been initialized yet. Call set_session_manager() first.")
+    return session_manager
+
+session_manager: Optional[SessionManager] = None
@@ -0,0 +1,49 @@
+# Edge pre-aggregation: for channels with an aggregation window the raw counter readings from every
+# poll are turned into deltas here and only the sum of those deltas is published once per window
+# (message.window_seconds tells the consumer the value is already a delta). Channels without a
+# window pass straight through.
+
+import dataclasses
+from typing import Dict, List, Optional
+from utils.message import TelemetryMessage
+
+
+@dataclasses.dataclass
+class ChannelWindow:
+    window_seconds: int
+    window_start: int
+    last_value: int
+    total: int = 0
+
+
+class WindowAggregator:
+    def __init__(self, max_delta_per_poll: int = 50):
+        # same sanity clamp the consumer applies to a single delta
+        self.max_delta_per_poll = max_delta_per_poll
+        self._channels = {}  # key: (mac, data_field_index), value: ChannelWindow
+
+    def apply(self, messages: List[TelemetryMessage], windows: Dict[int, Optional[int]]) -> List[TelemetryMessage]:
+        # windows maps data_field_index -> window in seconds (None/0 means publish every poll)
+        out = []
+        for msg in messages:
+            window_seconds = windows.get(msg.data_field_index)
+            key = (msg.source_mac, msg.data_field_index)
+            if not window_seconds:
+                self._channels.pop(key, None)
+                out.append(msg)
+                continue
+            channel = self._channels.get(key)
+            if channel is None or channel.window_seconds != window_seconds:
+                # first reading only sets the baseline
+                self._channels[key] = ChannelWindow(window_seconds, msg.timestamp, msg.value)
+                continue
+            if msg.value > channel.last_value:
+                delta = msg.value - channel.last_value
+                channel.total += 1 if delta > self.max_delta_per_poll else delta
+            # a lower value means the counter was reset, it becomes the new baseline
+            channel.last_value = msg.value
+            if msg.timestamp - channel.window_start >= window_seconds:
+                out.append(dataclasses.replace(msg, value=channel.total, window_seconds=window_seconds))
+                channel.window_start = msg.timestamp
+                channel.total = 0
+        return out
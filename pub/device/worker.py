@@ -3,11 +3,16 @@ import threading
 import logging
 import time
 import copy
-from device.utils.auth_flow_registry import auth_flow_registry
+import json
 from device.utils.scraper_registry import scraper_registry
 from device.utils.brute_force import brute_force
-from db.utils.db_session import SessionLocal  # your original session factory
-from db.repository.message_info_config_repository import MessageInfoConfigRepository
+from device.utils.http_transport import get_transport
+from device.utils.session_manager import get_session_manager
+from device.utils.session_manager import is_auth_failure
+from device.utils.window_aggregator import WindowAggregator
+from device.utils.circuit_breaker import CircuitBreaker
+from device.utils.circuit_breaker import ProbeBudget
+from master.message_info_config_cache import get_message_info_config_cache
 from utils.logging import setup_logger
 from utils.message import TelemetryMessage
 from utils.message import Product
@@ -15,12 +20,15 @@ from utils.message import Zone
 from utils.message import Machine
 from utils.message import MachineStage
 from utils.message import EventType
+from utils.codec import encode_payload
+from utils.codec import CONTENT_TYPE_HEADER
+from utils.codec import JSON_CONTENT_TYPE
 from config import load_config
 
 logger = setup_logger(__name__)
 
 class DeviceWorker(threading.Thread):
-    def __init__(self, device: dict, validate, invalidate, update_device_field, publish):
+    def __init__(self, device: dict, validate, invalidate, update_device_field, publish, poll_interval=5, publish_batches=False, content_type=JSON_CONTENT_TYPE, change_filter=None, adaptive_interval=None, breaker=None):
         super().__init__()
         self.device = device
         self.validate = validate
@@ -29,76 +37,140 @@ class DeviceWorker(threading.Thread):
         self.publish = publish
         self.daemon = True
         self.running = True
-        self.config_repo = None
+        self._wake = threading.Event()  # set by stop() so a stopped worker doesn't sleep out its interval
+        # cleared by the watcher when a replacement worker for the same mac starts before this one exited
+        self.owns_session = True
+        self.poll_interval = poll_interval
+        # when set, every channel from one scrape goes out as a single TelemetryBatchMessage
+        self.publish_batches = publish_batches
+        # wire format of published payloads, see utils/codec.py
+        self.content_type = content_type
+        self.headers = {CONTENT_TYPE_HEADER: content_type}
+        # optional ChangeFilter, only readings that changed (plus periodic keyframes) get published
+        self.change_filter = change_filter
+        # channels with an aggregation_window (device or message_info_config row) publish summed deltas
+        self.aggregator = WindowAggregator()
+        # optional AdaptiveInterval, poll_interval then follows how fast the counters are moving
+        self.adaptive_interval = adaptive_interval
+        # quarantines the device after repeated failures, shared with the watcher which re-probes it later
+        self.breaker = breaker if breaker is not None else CircuitBreaker(ProbeBudget())
 
     def run(self):
-        session = SessionLocal()
-        self.config_repo = MessageInfoConfigRepository(session)
         mac = self.device.get("mac", "unknown")
         logger.info(f"Starting worker thread for device {mac}")
         while self.running:
-            if self.device.get('failures') > 5:
-                logger.debug(f"LOTS OF FAILURES: {self.device.get('failures')}")
-                self.exit_cleanly()
+            messages = self.poll_once()
             try:
-                if self.device.get("cookie_expires", -1) < int(time.time()):
-                    logger.critical(f"Refreshing cookie")
-                    self.device["cookie"] = self.get_cookie()
-                    self.reset_cookie_expiration()
-                    logger.critical(f"Refreshed cookie: {self.device.get('cookie')}")
-                logger.info(f"About to check cookie: {self.device.get('cookie')}")
-                if self.device.get("cookie", False):
-                    logger.info(f"About to scraped zee data")
-                    shared_timestamp = int(time.time())
-                    data = self.scrape()
-                    logger.info(f"Finished scraping le daataa: {data}")
-                    logger.critical(f"data: {data}")
-                    # Publish a message to NATS
-                    self.publish_message(data, shared_timestamp)
-
-                else:
-                    # brute_force will throw an error if all the auth flows fail
-                    password, username, auth_flow, scraper, cookie = brute_force(copy.deepcopy(self.device))
-                    if password is None or username is None or auth_flow is None or scraper is None:
-                        raise ValueError("Brute force failed")
-                    logger.critical(f"Brute force returned password:{password} username:{username} auth_flow:{auth_flow} scraper:{scraper}")
-                    self.device['password'] = password
-                    self.device['username'] = username
-                    self.device['auth_flow'] = auth_flow
-                    self.device['scraper'] = scraper
-                    self.device['cookie'] = cookie
-                    self.reset_cookie_expiration()
-                    self.validate(password, username, auth_flow, scraper)
-                    self.update_device_field(password=password, username=username, auth_flow=auth_flow, scraper=scraper)
+                self.publish_messages(messages)
             except Exception as e:
-                logger.error(f"Device {self.device['mac']} failed: {e}")
-                self.device['failures'] += 1
-                logger.error(f"Incrementing device failure count {self.device.get('failures')}")
-
-            time.sleep(5)  # TODO replace with interval from config
-        session.close() # clean up
+                logger.error(f"Device {mac} failed to publish: {e}")
+                self.record_failure()
+            if self.running:
+                self._wake.wait(self.poll_interval)
+        if self.owns_session:
+            self.close_session() # clean up
         logger.debug(f"Thread stopping for device {mac}")
 
+    def poll_once(self):
+        # Runs a single auth/scrape cycle and returns the messages that should be published.
+        # This is blocking (http) so the async engine calls it from an executor and
+        # publishes the returned messages itself on the broker's event loop
+        try:
+            # the SessionManager refreshes cookies ahead of expiry in the background,
+            # this only logs in inline when there is no valid cookie at all
+            self.device["cookie"] = self.get_cookie()
+            logger.info(f"About to check cookie: {self.device.get('cookie')}")
+            if self.device.get("cookie", False):
+                logger.info(f"About to scraped zee data")
+                shared_timestamp = int(time.time())
+                data = self.scrape_with_reauth()
+                logger.info(f"Finished scraping le daataa: {data}")
+                logger.critical(f"data: {data}")
+                self.update_device_field(last_seen=shared_timestamp, last_data=json.dumps(data))
+                self.record_success()
+                self.adapt_poll_interval(data)
+                return self.build_messages(data, shared_timestamp)
+            else:
+                # brute_force will throw an error if all the auth flows fail
+                password, username, auth_flow, scraper, cookie = brute_force(copy.deepcopy(self.device))
+                if password is None or username is None or auth_flow is None or scraper is None:
+                    raise ValueError("Brute force failed")
+                logger.critical(f"Brute force returned password:{password} username:{username} auth_flow:{auth_flow} scraper:{scraper}")
+                self.device['password'] = password
+                self.device['username'] = username
+                self.device['auth_flow'] = auth_flow
+                self.device['scraper'] = scraper
+                self.device['cookie'] = cookie
+                get_session_manager().store(self.device, cookie)
+                self.validate(password, username, auth_flow, scraper)
+                self.device['valid'] = True
+                self.update_device_field(password=password, username=username, auth_flow=auth_flow, scraper=scraper)
+                self.record_success()
+        except Exception as e:
+            logger.error(f"Device {self.device['mac']} failed: {e}")
+            self.record_failure()
+        return []
+
+    def record_success(self):
+        recovered = self.breaker.record_success()
+        if self.device.get('failures'):
+            self.device['failures'] = 0
+            self.update_device_field(failures=0)
+        if recovered or not self.device.get('valid', True):
+            # a quarantine probe got through, put the device back in the registry as valid
+            logger.info(f"Device {self.device.get('mac')} recovered")
+            self.device['valid'] = True
+            self.validate(self.device.get('password'), self.device.get('username'), self.device.get('auth_flow'), self.device.get('scraper'))
+
+    def record_failure(self):
+        self.device['failures'] = (self.device.get('failures') or 0) + 1
+        logger.error(f"Incrementing device failure count {self.device.get('failures')}")
+        if self.breaker.record_failure():
+            logger.warning(f"Device {self.device.get('mac')} quarantined after {self.device['failures']} failures, next probe in {self.breaker.next_probe - time.monotonic():.0f}s")
+            self.update_device_field(failures=self.device['failures'])
+            self.exit_cleanly()
+
+    def adapt_poll_interval(self, data):
+        if self.adaptive_interval is None or data is None:
+            return
+        min_interval, max_interval = get_message_info_config_cache().poll_bounds(self.device.get("mac"))
+        interval = self.adaptive_interval.observe(data, min_interval, max_interval)
+        if interval != self.poll_interval:
+            logger.debug(f"Poll interval for {self.device.get('mac')} now {interval:.2f}s")
+        self.poll_interval = interval
+
+    def close_session(self):
+        get_transport().close_session(self.device.get("mac"))
+        get_session_manager().forget(self.device.get("mac"))
+
     def exit_cleanly(self):
         self.invalidate()
         self.stop()
 
     def stop(self):
         self.running = False
+        self._wake.set()
         logger.info(f"Stopping worker thread for device {self.device.get('mac', 'unknown')}")
 
-    def reset_cookie_expiration(self):
-        expires_at = int(time.time()) + (20 * 60)  # 20 minutes from now
-        self.device['cookie_expires'] = expires_at
-
     def get_cookie(self):
         auth_flow = self.device['auth_flow'] 
         logger.debug(f"Using auth_flow: {auth_flow}")
         if auth_flow is None:
             return None
-        get_cookie_fn = auth_flow_registry.get(auth_flow)
-        data = get_cookie_fn(self.device)
-        return data
+        return get_session_manager().cookie_for(self.device)
+
+    def scrape_with_reauth(self):
+        try:
+            return self.scrape()
+        except Exception as e:
+            if not is_auth_failure(e):
+                raise
+            # cookie was rejected before it expired (device rebooted, session evicted), log in
+            # again right away and retry once instead of failing the poll
+            logger.warning(f"Device {self.device.get('mac')} rejected its cookie, re-authenticating")
+            get_session_manager().invalidate(self.device.get("mac"))
+            self.device["cookie"] = self.get_cookie()
+            return self.scrape()
 
     def scrape(self):
         scraper = self.device['scraper']
@@ -106,26 +178,51 @@ class DeviceWorker(threading.Thread):
         if scraper is None:
             return None
         scraper_fn = scraper_registry.get(scraper)
-        data = scraper_fn(self.device)
+        data = get_transport().call("scrape", self.device, scraper_fn)
         return data
 
-    def publish_if_valid(self, msg):
+    def is_valid(self, msg):
         # for some reason some devices appear to use -3000 or -5000 as their starting value
         # so the validity check can't be as naive as checking if the value is greater than 0
-        if msg.value is not 0:
-            msg_as_bytes = msg.to_bytes()
-            self.publish(msg_as_bytes)
-        else:
-            logger.info(f"dropping message with value {msg.value} \n{msg}")
+        if msg.value != 0:
+            return True
+        logger.info(f"dropping message with value {msg.value} \n{msg}")
+        return False
+
+    def publish_if_valid(self, msg):
+        self.publish_messages([msg])
+
+    def publish_messages(self, messages):
+        valid_messages = [msg for msg in messages if self.is_valid(msg)]
+        if self.change_filter is not None:
+            # aggregated sums are not counter readings, an unchanged sum still has to be published
+            raw = [msg for msg in valid_messages if msg.window_seconds is None]
+            aggregated = [msg for msg in valid_messages if msg.window_seconds is not None]
+            valid_messages = self.change_filter.filter(raw) + aggregated
+        if not valid_messages:
+            return
+        for payload in encode_payload(valid_messages, self.content_type, batch=self.publish_batches):
+            self.publish(payload, self.headers)
 
 
     def publish_message(self, data, shared_timestamp):
+        self.publish_messages(self.build_messages(data, shared_timestamp))
+
+    def build_messages(self, data, shared_timestamp):
         mac = self.device.get("mac")
         ip = self.device.get("ip")
+        config_cache = get_message_info_config_cache()
+        messages = []
+        windows = {}
         for index, count in enumerate(data):
-            already_published = False
+            if count is None:
+                continue  # padding between endpoint slots, see fetch_endpoints
+            already_built = False
+            record = config_cache.get(mac, int(index))
+            windows[int(index)] = self.aggregation_window_for(record)
             try:
-                record = self.config_repo.get_by_mac_and_index(mac, int(index))
+                if record is None:
+                    raise LookupError(f"No message_info_config for {mac} index {index}")
                 msg = TelemetryMessage(
                         timestamp=shared_timestamp,
                         source_mac=mac,
@@ -137,12 +234,12 @@ class DeviceWorker(threading.Thread):
                         value=int(count),
                         data_field_index=int(index)
                         )
-                self.publish_if_valid(msg)
-                already_published = True
+                messages.append(msg)
+                already_built = True
             except Exception as e:
                 logger.error(f"{e}")
                 logger.error(f"Could not fetch data from message_info_config, publishing raw data instead")
-            if not already_published:
+            if not already_built:
                 msg = TelemetryMessage(
                         timestamp=shared_timestamp,
                         source_mac=mac,
@@ -150,4 +247,10 @@ class DeviceWorker(threading.Thread):
                         value=int(count),
                         data_field_index=int(index)
                         )
-                self.publish_if_valid(msg)
+                messages.append(msg)
+        return self.aggregator.apply(messages, windows)
+
+    def aggregation_window_for(self, record):
+        if record is not None and record.aggregation_window is not None:
+            return record.aggregation_window
+        return self.device.get("aggregation_window")
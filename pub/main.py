@@ -2,11 +2,21 @@
 import threading
 import time
 from utils.logging import setup_logger
+from utils.metrics import start_metrics_server
 from config import load_config
 from master.scanner import ScannerThread
 from master.watcher import WatcherThread
 from master.device_registry import DeviceRegistry  
 from master.device_registry import set_registry  # Singleton instance
+from master.message_info_config_cache import MessageInfoConfigCache
+from master.message_info_config_cache import set_message_info_config_cache  # Singleton instance
+from device.utils.http_transport import HttpTransport
+from device.utils.http_transport import set_transport  # Singleton instance
+from device.utils.brute_force import CredentialDiscovery
+from device.utils.brute_force import set_discovery  # Singleton instance
+from device.utils.fingerprint import FingerprintStore
+from device.utils.session_manager import SessionManager
+from device.utils.session_manager import set_session_manager  # Singleton instance
 
 logger = setup_logger(__name__)
 
@@ -46,13 +56,40 @@ def main():
     for key, value in config.items():
         logger.info(f"  {key}: {value}")
 
+    start_metrics_server(config)
+
     # Store config in registry 
     if config.get("process", {}).get("mode") == "debug":
         lock = ProfiledLock()
+        lock_factory = ProfiledLock
     else:
         lock = threading.Lock()
-    singleton_instance = DeviceRegistry(lock=lock, config=config)
+        lock_factory = threading.Lock
+    singleton_instance = DeviceRegistry(lock=lock, config=config, lock_factory=lock_factory)
     set_registry(singleton_instance)
+    singleton_instance.start_persistence()
+
+    # Process wide message_info_config cache, workers read it instead of querying the database
+    config_cache = MessageInfoConfigCache(config=config)
+    set_message_info_config_cache(config_cache)
+    config_cache.start_and_wait()
+    logger.info("MessageInfoConfig cache started")
+
+    # Shared pooled http transport for auth flows and scrapers
+    transport = HttpTransport(config=config)
+    set_transport(transport)
+
+    # Background cookie refresh, resumes the sessions persisted before the last shutdown
+    sessions = SessionManager(config=config)
+    set_session_manager(sessions)
+    sessions.load_persisted(singleton_instance.get_all_devices_copy())
+    sessions.start()
+
+    # Shared credential discovery pool, caps concurrent logins across every new device.
+    # Devices whose fingerprint matches an already onboarded type get one targeted attempt first
+    fingerprints = FingerprintStore(config=config)
+    discovery = CredentialDiscovery(config=config, fingerprints=fingerprints)
+    set_discovery(discovery)
 
     # Start scanner thread
     scanner = ScannerThread(config=config)
@@ -74,8 +111,15 @@ def main():
         logger.info("Shutting down...")
         scanner.stop()
         watcher.stop()
+        config_cache.stop()
         scanner.join()
         watcher.join()
+        if watcher.broker.is_alive():
+            watcher.broker.join(timeout=10)
+        discovery.close()
+        sessions.stop()
+        transport.close()
+        singleton_instance.close()
         logger.info("Shutdown complete")
 
 if __name__ == "__main__":
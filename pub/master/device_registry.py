@@ -2,9 +2,14 @@
 
 from db.utils.db_session import SessionLocal
 from db.repository.device_repository import DeviceRepository
+from master.registry_writer import RegistryWriterThread
 import threading
+from contextlib import contextmanager, ExitStack
+from dataclasses import dataclass
+from types import MappingProxyType
+from enum import Enum
 from utils.logging import setup_logger
-from typing import Optional
+from typing import Callable, Optional
 
 
 
@@ -12,18 +17,34 @@ logger = setup_logger(__name__)
 
 _lock_type = type(threading.Lock())
 
+class DeviceEventType(Enum):
+    ADDED = "added"
+    VALIDATED = "validated"
+    INVALIDATED = "invalidated"
+    IP_CHANGED = "ip_changed"
+
+@dataclass(frozen=True)
+class DeviceEvent:
+    type: DeviceEventType
+    mac: str
+
 
 class DeviceRegistry:
-    def __init__(self, lock: threading.Lock, config: dict):
+    def __init__(self, lock: threading.Lock, config: dict, lock_factory=threading.Lock):
         if not (hasattr(lock, "acquire") and callable(lock.acquire) and
                 hasattr(lock, "release") and callable(lock.release)):
             raise TypeError(f"Expected lock to be a Lock-like object, got {type(lock).__name__}")
         if not isinstance(config, dict):
             raise TypeError(f"Expected config to be dict, got {type(config).__name__}")
 
-        self._devices = {}  # key: mac, value: device dict
-        self._lock = lock
+        self._devices = {}  # key: mac, value: immutable device record (MappingProxyType)
+        self._lock = lock  # serializes adding/removing devices
+        # per device changes only lock the stripe the mac hashes to
+        self._stripes = [lock_factory() for _ in range(config.get("registry_lock_stripes", 64))]
         self._config = config
+        self._subscribers = []  # callables taking a DeviceEvent
+        # mutations are applied in memory under the lock and persisted later by this thread
+        self._writer = RegistryWriterThread(config=config)
 
         session = SessionLocal()
         try:
@@ -31,7 +52,7 @@ class DeviceRegistry:
             devices = repo.get_all_devices()  # should return a list of Device ORM instances
             if devices:
                 self._devices = {
-                    device.mac: {
+                    device.mac: MappingProxyType({
                         "mac": device.mac,
                         "ip": device.ip,
                         "valid": device.valid,
@@ -44,7 +65,8 @@ class DeviceRegistry:
                         "scraper": device.scraper,
                         "last_data": device.last_data,
                         "last_seen": device.last_seen,
-                    }
+                        "aggregation_window": device.aggregation_window,
+                    })
                     for device in devices
                 }
         except Exception as e:
@@ -55,117 +77,135 @@ class DeviceRegistry:
     def get_config(self):
         return self._config
 
+    def start_persistence(self):
+        self._writer.start()
+
+    def close(self):
+        # flushes every pending change to the database before returning
+        self._writer.stop()
+        self._writer.join()
+
+    def subscribe(self, callback: Callable[[DeviceEvent], None]):
+        # callbacks run on the thread that made the change, outside the registry lock,
+        # so they should only hand the event off (e.g. queue.put)
+        self._subscribers.append(callback)
+
+    def _notify(self, event_type: DeviceEventType, mac: str):
+        event = DeviceEvent(type=event_type, mac=mac)
+        for callback in list(self._subscribers):
+            try:
+                callback(event)
+            except Exception as e:
+                logger.error(f"Device event subscriber failed on {event}: {e}")
+
+    def _stripe(self, mac):
+        return self._stripes[hash(mac) % len(self._stripes)]
+
+    @contextmanager
+    def _membership_change(self):
+        # adding or removing a device swaps in a new dict, holding every stripe means no
+        # per-device update can land in the old dict while it is being copied
+        with self._lock, ExitStack() as stack:
+            for stripe in self._stripes:
+                stack.enter_context(stripe)
+            yield
+
+    def _update(self, mac, **changes):
+        # caller holds the stripe lock for mac. Records are never modified, the new record replaces
+        # the old one under the same key which doesn't resize the dict, so lock-free readers are safe
+        current = self._devices.get(mac)
+        if current is None:
+            return False
+        self._devices[mac] = MappingProxyType({**current, **changes})
+        self._writer.update(mac, **changes)
+        return True
+
     def add_or_update_device(self, mac, ip):
-        with self._lock:
-            if mac not in self._devices:
-                device_data = {
-                    'mac': mac,
-                    'ip': ip,
-                    'valid': True,
-                    'failures': 0,
-                    'username': None,
-                    'password': None,
-                    'cookie': None,
-                    'cookie_expires': 0,
-                    'auth_flow': None,
-                    'scraper': None,
-                    'last_data': None,
-                    'last_seen': None,
-                }
-                self._devices[mac] = device_data
-
-
-                session = SessionLocal()
-                try:
-                    repo = DeviceRepository(session)
-                    repo.add_device(device_data)
-                    logger.info(f"Persisted to database new device: {mac} @ {ip}")
-                except Exception as e:
-                    logger.error(f"Database could not persist new device: {mac} @ {ip}. Error: {e}")
-                    session.rollback()  # optional but good practice on error
-                finally:
-                    session.close()
-                logger.info(f"Added new device: {mac} @ {ip}")
-            else:
-                self._devices[mac]['ip'] = ip
-                # TODO modify database entry
-                logger.debug(f"Updated device IP: {mac} -> {ip}")
+        event_type = None
+        if mac not in self._devices:
+            with self._membership_change():
+                if mac not in self._devices:
+                    device_data = {
+                        'mac': mac,
+                        'ip': ip,
+                        'valid': True,
+                        'failures': 0,
+                        'username': None,
+                        'password': None,
+                        'cookie': None,
+                        'cookie_expires': 0,
+                        'auth_flow': None,
+                        'scraper': None,
+                        'last_data': None,
+                        'last_seen': None,
+                        'aggregation_window': None,
+                    }
+                    devices = dict(self._devices)
+                    devices[mac] = MappingProxyType(device_data)
+                    self._devices = devices
+                    self._writer.add(device_data)
+                    logger.info(f"Added new device: {mac} @ {ip}")
+                    event_type = DeviceEventType.ADDED
+        if event_type is None:
+            with self._stripe(mac):
+                device = self._devices.get(mac)
+                if device is not None and device['ip'] != ip:
+                    self._update(mac, ip=ip)
+                    logger.debug(f"Updated device IP: {mac} -> {ip}")
+                    event_type = DeviceEventType.IP_CHANGED
+        if event_type is not None:
+            self._notify(event_type, mac)
 
     def get_handle_to_self_invalidate(self, mac):
         def invalidate():
-            with self._lock:
-                if mac in self._devices:
-                    self._devices[mac]['valid'] = False
+            event_type = None
+            with self._stripe(mac):
+                if self._update(mac, valid=False):
                     logger.warning(f"Device marked invalid: {mac}")
-                    # modify database entry
-                    session = SessionLocal()
-                    try:
-                        repo = DeviceRepository(session)
-                        kwargs = { 'valid' : False }
-                        repo.update_device(mac, **kwargs)
-                        logger.info(f"Invalidated database record for: {mac}")
-                    except Exception as e:
-                        logger.error(f"Database could not invalidate: {mac} . Error: {e}")
-                        session.rollback()  
-                    finally:
-                        session.close()
+                    event_type = DeviceEventType.INVALIDATED
+            if event_type is not None:
+                self._notify(event_type, mac)
         return invalidate
 
     def get_handle_to_self_validate(self, mac):
         def validate(password, username, auth_flow, scraper):
-            with self._lock:
-                if mac in self._devices:
-                    self._devices[mac]['valid'] = True
-                    self._devices[mac]['password'] = password
-                    self._devices[mac]['username'] = username
-                    self._devices[mac]['auth_flow'] = auth_flow
-                    self._devices[mac]['scraper'] = scraper
+            event_type = None
+            with self._stripe(mac):
+                kwargs = {
+                    'valid': True,
+                    'password': password,
+                    'username': username,
+                    'auth_flow': auth_flow,
+                    'scraper': scraper,
+                }
+                if self._update(mac, **kwargs):
                     logger.info(f"Device marked valid: {mac}")
-                    # modify database entry
-                    session = SessionLocal()
-                    try:
-                        repo = DeviceRepository(session)
-                        kwargs = { 'valid' : True }
-                        repo.update_device(mac, **kwargs)
-                        logger.info(f"Validated database record for: {mac}")
-                    except Exception as e:
-                        logger.error(f"Database could not validate: {mac} . Error: {e}")
-                        session.rollback()  
-                    finally:
-                        session.close()
+                    event_type = DeviceEventType.VALIDATED
+            if event_type is not None:
+                self._notify(event_type, mac)
         return validate
 
     def get_handle_to_update_device_field(self, mac):
         def update_device_field(**kwargs):
-            with self._lock:
-                if mac in self._devices:
-                    for key, value in kwargs.items():
-                        self._devices[mac][key] = value
-                    # modify database entry
-                    session = SessionLocal()
-                    try:
-                        repo = DeviceRepository(session)
-                        repo.update_device(mac, **kwargs)
-                        logger.info(f"Modified database record for {mac} fields {kwargs}")
-                    except Exception as e:
-                        logger.error(f"Database could not modify fields {kwargs} . Error: {e}")
-                        session.rollback()  
-                    finally:
-                        session.close()
+            with self._stripe(mac):
+                self._update(mac, **kwargs)
         return update_device_field
 
+    # Readers never take a lock: self._devices is only ever swapped for a new dict when devices are
+    # added or removed, and each record is an immutable mapping. Callers that need to modify a
+    # device keep their own dict(record) copy and write back through the update handles.
     def get_all_devices_copy(self):
-        with self._lock:
-            return list(self._devices.values())
+        return list(self._devices.values())
 
     def get_device(self, mac):
-        with self._lock:
-            return self._devices.get(mac)
+        return self._devices.get(mac)
 
     def remove_device(self, mac):
-        with self._lock:
+        with self._membership_change():
             if mac in self._devices:
-                del self._devices[mac]
+                devices = dict(self._devices)
+                del devices[mac]
+                self._devices = devices
                 logger.info(f"Removed device: {mac}")
 
 # This handles the singleton situation 
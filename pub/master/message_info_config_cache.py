@@ -0,0 +1,167 @@
+# master/message_info_config_cache.py
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+from sqlalchemy import text
+from db.utils.db_session import SessionLocal, engine
+from db.repository.message_info_config_repository import MessageInfoConfigRepository
+from utils.logging import setup_logger
+
+logger = setup_logger(__name__)
+
+
+@dataclass(frozen=True)
+class MessageInfoConfigRecord:
+    mac: str
+    data_field_index: int
+    ip: str
+    source_name: Optional[str] = None
+    zone: Optional[str] = None
+    machine: Optional[str] = None
+    machine_stage: Optional[str] = None
+    event_type: Optional[str] = None
+    units: Optional[str] = None
+    pieces: Optional[int] = None
+    estimated_pieces: Optional[int] = None
+    rfid: Optional[str] = None
+    aggregation_window: Optional[int] = None
+    min_poll_interval: Optional[int] = None
+    max_poll_interval: Optional[int] = None
+
+
+# Process wide, read-mostly copy of the message_info_config table keyed by (mac, data_field_index).
+# Workers read self._records without taking a lock: a reload builds a brand new dict and swaps the
+# reference in one assignment, so a reader only ever sees the old or the new table, never a mix.
+class MessageInfoConfigCache(threading.Thread):
+    def __init__(self, config: dict):
+        super().__init__()
+        if not isinstance(config, dict):
+            raise TypeError(f"Expected config to be dict, got {type(config).__name__}")
+        self.daemon = True
+        self.running = True
+        self.refresh_interval = config.get("message_info_config_refresh_interval", 10)
+        self._records = {}  # key: (mac, data_field_index), value: MessageInfoConfigRecord
+        self._poll_bounds = {}  # key: mac, value: (min_poll_interval, max_poll_interval)
+        self._version = None
+        self._conn = None
+        self._started = threading.Event()
+
+    def run(self):
+        logger.info("MessageInfoConfig cache starting")
+        self._open_version_connection()
+        self.refresh_if_changed()
+        self._started.set()
+        while self.running:
+            time.sleep(self.refresh_interval)
+            self.refresh_if_changed()
+        if self._conn is not None:
+            self._conn.close()
+
+    def start_and_wait(self):
+        self.start()
+        self._started.wait()  # Block until the first load has happened
+
+    def stop(self):
+        self.running = False
+
+    def get(self, mac: str, index: int) -> Optional[MessageInfoConfigRecord]:
+        return self._records.get((mac, index))
+
+    def poll_bounds(self, mac: str):
+        # (min, max) poll interval for a device, either can be None when no channel sets it
+        return self._poll_bounds.get(mac, (None, None))
+
+    def _open_version_connection(self):
+        # On sqlite triggers bump table_versions.version on every write to message_info_config, so
+        # the reload is skipped while nothing in the table changed. PRAGMA data_version can't be
+        # used for this, it changes on any commit to the file and the registry commits every flush.
+        # Any other database has no triggers and falls back to reloading every refresh_interval.
+        if engine.dialect.name != "sqlite":
+            return
+        try:
+            self._conn = engine.connect()
+        except Exception as e:
+            logger.error(f"Could not open connection for message_info_config version checks: {e}")
+            self._conn = None
+
+    def _read_version(self):
+        if self._conn is None:
+            return None
+        try:
+            version = self._conn.execute(
+                text("SELECT version FROM table_versions WHERE name = 'message_info_config'")
+            ).scalar()
+            self._conn.commit()  # end the read transaction so the next read sees new commits
+            return version
+        except Exception as e:
+            logger.error(f"Could not read message_info_config version: {e}")
+            self._conn.rollback()
+            return None
+
+    def refresh_if_changed(self):
+        version = self._read_version()
+        if version is not None and version == self._version:
+            return
+        if self.reload():
+            self._version = version
+
+    def reload(self) -> bool:
+        session = SessionLocal()
+        try:
+            repo = MessageInfoConfigRepository(session)
+            records = {
+                (row.mac, row.data_field_index): MessageInfoConfigRecord(
+                    mac=row.mac,
+                    data_field_index=row.data_field_index,
+                    ip=row.ip,
+                    source_name=row.source_name,
+                    zone=row.zone,
+                    machine=row.machine,
+                    machine_stage=row.machine_stage,
+                    event_type=row.event_type,
+                    units=row.units,
+                    pieces=row.pieces,
+                    estimated_pieces=row.estimated_pieces,
+                    rfid=row.rfid,
+                    aggregation_window=row.aggregation_window,
+                    min_poll_interval=row.min_poll_interval,
+                    max_poll_interval=row.max_poll_interval,
+                )
+                for row in repo.get_all()
+            }
+        except Exception as e:
+            logger.error(f"Failed to load message_info_config: {e}")
+            return False
+        finally:
+            session.close()
+        if records != self._records:
+            self._poll_bounds = self._build_poll_bounds(records)
+            self._records = records  # atomic swap, readers never lock
+            logger.info(f"Loaded {len(records)} message_info_config records")
+        return True
+
+    @staticmethod
+    def _build_poll_bounds(records):
+        # the busiest channel decides: the fastest minimum and the shortest maximum of the device's rows
+        bounds = {}
+        for record in records.values():
+            lo, hi = bounds.get(record.mac, (None, None))
+            if record.min_poll_interval is not None:
+                lo = record.min_poll_interval if lo is None else min(lo, record.min_poll_interval)
+            if record.max_poll_interval is not None:
+                hi = record.max_poll_interval if hi is None else min(hi, record.max_poll_interval)
+            bounds[record.mac] = (lo, hi)
+        return bounds
+
+# This handles the singleton situation
+def set_message_info_config_cache(instance: MessageInfoConfigCache):
+    global message_info_config_cache
+    message_info_config_cache = instance
+
+def get_message_info_config_cache() -> MessageInfoConfigCache:
+    if message_info_config_cache is None:
+        raise RuntimeError("MessageInfoConfigCache has not been initialized yet. Call set_message_info_config_cache() first.")
+    return message_info_config_cache
+
+message_info_config_cache: Optional[MessageInfoConfigCache] = None
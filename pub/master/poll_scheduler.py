@@ -0,0 +1,193 @@
+# master/poll_scheduler.py
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils.logging import setup_logger
+from utils import metrics
+
+logger = setup_logger(__name__)
+
+# fractional part of the golden ratio, successive multiples of it are spread evenly over [0, 1)
+# however many devices get added, so phases stay spread without replanning
+GOLDEN_RATIO_FRACTION = (math.sqrt(5) - 1) / 2
+
+
+# Hierarchical timing wheel. Level 0 has one slot per tick, each higher level has one slot per full
+# turn of the level below it. Entries far in the future sit in a coarse slot and are cascaded down
+# as their time gets closer, so scheduling and expiring are O(1) however many devices there are.
+class TimingWheel:
+    def __init__(self, tick: float, wheel_sizes=(256, 64, 64), now: float = None):
+        self.tick = tick
+        self.wheel_sizes = wheel_sizes
+        self.levels = [[[] for _ in range(size)] for size in wheel_sizes]
+        self.spans = []  # ticks covered by one slot of each level
+        span = 1
+        for size in wheel_sizes:
+            self.spans.append(span)
+            span *= size
+        self.total_span = span
+        self.overflow = []
+        self.current_tick = self._to_tick(time.monotonic() if now is None else now)
+
+    def _to_tick(self, t: float) -> int:
+        return int(t / self.tick)
+
+    def schedule(self, key, due: float):
+        # never schedule into the past, a late entry fires on the next tick
+        due_tick = max(math.ceil(due / self.tick), self.current_tick + 1)
+        self._insert(due_tick, key)
+
+    def _insert(self, due_tick: int, key):
+        delta = due_tick - self.current_tick
+        for level, size in enumerate(self.wheel_sizes):
+            span = self.spans[level]
+            if delta < span * size:
+                self.levels[level][(due_tick // span) % size].append((due_tick, key))
+                return
+        self.overflow.append((due_tick, key))
+
+    def advance(self, now: float):
+        # Moves the wheel up to now and returns [(due_time, key), ...] for everything that expired
+        target = self._to_tick(now)
+        expired = []
+        while self.current_tick < target:
+            self.current_tick += 1
+            self._cascade()
+            slot = self.current_tick % self.wheel_sizes[0]
+            bucket, self.levels[0][slot] = self.levels[0][slot], []
+            for due_tick, key in bucket:
+                if due_tick <= self.current_tick:
+                    expired.append((due_tick * self.tick, key))
+                else:
+                    self._insert(due_tick, key)
+        return expired
+
+    def _cascade(self):
+        # highest level first so entries can fall through several levels on the same tick
+        if self.current_tick % self.total_span == 0:
+            pending, self.overflow = self.overflow, []
+            for due_tick, key in pending:
+                self._insert(due_tick, key)
+        for level in range(len(self.wheel_sizes) - 1, 0, -1):
+            span = self.spans[level]
+            if self.current_tick % span:
+                continue
+            slot = (self.current_tick // span) % self.wheel_sizes[level]
+            bucket, self.levels[level][slot] = self.levels[level][slot], []
+            for due_tick, key in bucket:
+                self._insert(due_tick, key)
+
+
+# Owns every device's next due time. Due polls are handed to a fixed size thread pool instead of
+# each device sleeping in its own thread, and new devices get phases spread across their interval
+# so a restart doesn't make the whole fleet poll in the same instant.
+class PollScheduler(threading.Thread):
+    def __init__(self, config: dict):
+        super().__init__()
+        if not isinstance(config, dict):
+            raise TypeError(f"Expected config to be dict, got {type(config).__name__}")
+        scheduler_config = config.get("scheduler", {})
+        self.daemon = True
+        self.running = True
+        self.tick = scheduler_config.get("tick", 0.1)
+        self.pool_size = scheduler_config.get("pool_size", 32)
+        self.lag_warning = scheduler_config.get("lag_warning_seconds", 2)
+        self.executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="poll")
+        self.wheel = TimingWheel(self.tick)
+        self.workers = {}  # key: mac, value: DeviceWorker
+        self.busy = set()  # macs with a poll running on the pool
+        self.added = 0
+        self.last_lag = 0.0
+        self._lock = threading.Lock()
+        metrics.scheduled_devices.set_function(lambda: len(self.workers))
+        metrics.poll_schedule_lag.set_function(lambda: self.last_lag)
+
+    def add(self, worker):
+        mac = worker.device.get("mac", "unknown")
+        with self._lock:
+            if mac in self.workers:
+                return
+            self.workers[mac] = worker
+            phase = (self.added * GOLDEN_RATIO_FRACTION) % 1.0
+            self.added += 1
+            self.wheel.schedule(mac, time.monotonic() + phase * worker.poll_interval)
+        logger.info(f"Scheduled device {mac} every {worker.poll_interval}s, phase {phase:.2f}")
+
+    def remove(self, worker):
+        mac = worker.device.get("mac", "unknown")
+        worker.stop()
+        with self._lock:
+            if self.workers.get(mac) is worker:
+                del self.workers[mac]
+            in_flight = mac in self.busy
+            replaced = self._replaced(mac, worker)
+        # the wheel entry is dropped when it expires and the mac is no longer known, a poll that
+        # is still running closes the session itself when it finishes
+        if not in_flight and not replaced:
+            worker.close_session()
+
+    def _replaced(self, mac: str, worker) -> bool:
+        # caller holds self._lock. Sessions and cookies are keyed by mac only, once a replacement
+        # worker (IP_CHANGED) is scheduled closing them would pull them from under the new worker
+        current = self.workers.get(mac)
+        return current is not None and current is not worker
+
+    def run(self):
+        logger.info(f"Poll scheduler starting, tick {self.tick}s, pool size {self.pool_size}")
+        while self.running:
+            time.sleep(self.tick)
+            now = time.monotonic()
+            with self._lock:
+                expired = self.wheel.advance(now)
+                due = []
+                for due_time, mac in expired:
+                    worker = self.workers.get(mac)
+                    if worker is None:
+                        continue
+                    if mac in self.busy:
+                        # previous poll still running, try again one interval later
+                        metrics.poll_skipped_total.labels(reason="busy").inc()
+                        self.wheel.schedule(mac, due_time + worker.poll_interval)
+                        continue
+                    self.busy.add(mac)
+                    due.append((due_time, worker))
+            for due_time, worker in due:
+                self.executor.submit(self._run_poll, worker, due_time)
+        # shut the pool down from here, stop() only ends the loop so nothing is submitted afterwards
+        self.executor.shutdown(wait=False)
+
+    def _record_lag(self, lag: float, worker):
+        self.last_lag = lag
+        metrics.poll_schedule_lag_seconds.observe(lag)
+        if lag > self.lag_warning:
+            logger.warning(f"Poll for {worker.device.get('mac')} started {lag:.2f}s late, the poller is falling behind")
+
+    def _run_poll(self, worker, due_time: float):
+        mac = worker.device.get("mac", "unknown")
+        # measured when the poll actually starts, a saturated pool delays it past the dispatch
+        self._record_lag(time.monotonic() - due_time, worker)
+        try:
+            worker.publish_messages(worker.poll_once())
+        except Exception as e:
+            # poll_once handles its own failures, this is publishing
+            logger.error(f"Scheduled poll for {mac} failed: {e}")
+            worker.record_failure()
+        finally:
+            with self._lock:
+                self.busy.discard(mac)
+                if worker.running and self.workers.get(mac) is worker:
+                    # fixed rate from the previous due time keeps the phase, skip missed polls
+                    next_due = due_time + worker.poll_interval
+                    now = time.monotonic()
+                    if next_due < now:
+                        missed = math.ceil((now - next_due) / worker.poll_interval)
+                        metrics.poll_skipped_total.labels(reason="overrun").inc(missed)
+                        next_due += missed * worker.poll_interval
+                    self.wheel.schedule(mac, next_due)
+                replaced = self._replaced(mac, worker)
+            if not worker.running and not replaced:
+                worker.close_session()
+
+    def stop(self):
+        self.running = False
@@ -0,0 +1,108 @@
+# master/registry_writer.py
+import threading
+import time
+from db.utils.db_session import SessionLocal
+from db.model.device import Device
+from utils.logging import setup_logger
+
+logger = setup_logger(__name__)
+
+
+# Write-behind persistence for the DeviceRegistry. Registry mutations only record the changed
+# fields here and return; this thread writes them out in one transaction per flush. Repeated
+# updates for the same mac between flushes collapse into one row update (last value wins).
+class RegistryWriterThread(threading.Thread):
+    def __init__(self, config: dict):
+        super().__init__()
+        if not isinstance(config, dict):
+            raise TypeError(f"Expected config to be dict, got {type(config).__name__}")
+        writer_config = config.get("registry_writer", {})
+        self.daemon = True
+        self.running = True
+        self.flush_interval = writer_config.get("flush_interval", 2)
+        self.max_batch = writer_config.get("max_batch", 500)
+        self._inserts = {}  # key: mac, value: full device dict for devices not yet in the database
+        self._updates = {}  # key: mac, value: dict of changed fields
+        self._cond = threading.Condition()
+
+    def add(self, device_data: dict):
+        with self._cond:
+            self._inserts[device_data["mac"]] = dict(device_data)
+            self._updates.pop(device_data["mac"], None)
+            self._wake_if_full()
+
+    def update(self, mac: str, **fields):
+        with self._cond:
+            if mac in self._inserts:
+                # not written yet, fold the change into the insert
+                self._inserts[mac].update(fields)
+            else:
+                self._updates.setdefault(mac, {}).update(fields)
+            self._wake_if_full()
+
+    def _wake_if_full(self):
+        if len(self._inserts) + len(self._updates) >= self.max_batch:
+            self._cond.notify()
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._inserts) + len(self._updates)
+
+    def run(self):
+        logger.info("Registry writer starting")
+        while self.running:
+            with self._cond:
+                self._cond.wait(timeout=self.flush_interval)
+            self.flush()
+        self.flush()  # whatever arrived while stopping
+        logger.info("Registry writer stopped")
+
+    def stop(self):
+        self.running = False
+        with self._cond:
+            self._cond.notify()
+
+    def flush(self):
+        with self._cond:
+            inserts, self._inserts = self._inserts, {}
+            updates, self._updates = self._updates, {}
+        if not inserts and not updates:
+            return
+        started = time.perf_counter()
+        session = SessionLocal()
+        try:
+            for device_data in inserts.values():
+                session.merge(Device(**device_data))
+            if updates:
+                existing = {
+                    device.mac: device
+                    for device in session.query(Device).filter(Device.mac.in_(list(updates))).all()
+                }
+                for mac, fields in updates.items():
+                    device = existing.get(mac)
+                    if device is None:
+                        logger.error(f"Registry writer has updates for unknown device {mac}")
+                        continue
+                    for key, value in fields.items():
+                        setattr(device, key, value)
+            session.commit()
+            logger.info(f"Persisted {len(inserts)} new and {len(updates)} updated devices in {time.perf_counter() - started:.3f}s")
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Registry writer failed, will retry: {e}")
+            self._requeue(inserts, updates)
+        finally:
+            session.close()
+
+    def _requeue(self, inserts, updates):
+        # anything that changed again since the failed flush is newer and wins
+        with self._cond:
+            for mac, device_data in inserts.items():
+                device_data.update(self._updates.pop(mac, {}))
+                device_data.update(self._inserts.get(mac, {}))
+                self._inserts[mac] = device_data
+            for mac, fields in updates.items():
+                if mac in self._inserts:
+                    self._inserts[mac] = {**fields, **self._inserts[mac]}
+                    continue
+                self._updates[mac] = {**fields, **self._updates.get(mac, {})}
@@ -53,7 +53,7 @@ class ScannerThread(threading.Thread):
         for mac, ip in devices.items():
             registry = get_registry()
             device = registry.get_device(mac)
-            if device is None:
+            if device is None or device["ip"] != ip:
                 registry.add_or_update_device(mac, ip)
 
     def scan_network(self):
@@ -1,41 +1,144 @@
 import threading
 import time
+from queue import Queue, Empty
 from utils.logging import setup_logger
 from device.worker import DeviceWorker
+from device.async_poller import AsyncDevicePoller
+from master.poll_scheduler import PollScheduler
+from device.utils.change_filter import ChangeFilter
+from device.utils.adaptive_interval import AdaptiveInterval
+from device.utils.circuit_breaker import CircuitBreaker
+from device.utils.circuit_breaker import BreakerState
+from device.utils.circuit_breaker import ProbeBudget
 from master.device_registry import get_registry
+from master.device_registry import DeviceEventType
 from utils.message_broker import MessageBroker
+from utils.codec import JSON_CONTENT_TYPE
+from utils.codec import BINARY_CONTENT_TYPE
+from utils import metrics
 import asyncio
 
 logger = setup_logger(__name__)
 
+WIRE_FORMATS = {
+    "json": JSON_CONTENT_TYPE,
+    "binary": BINARY_CONTENT_TYPE,
+}
+
 class WatcherThread(threading.Thread):
     def __init__(self, config):
         super().__init__()
         self.daemon = True
         self.running = True
-        self.check_interval = config.get("device_check_interval", 10)
         self.device_threads = {}  # type: dict[str, DeviceWorker]
-        self.recheck_invalid_devices = False
-        self.count_down_before_recheck = config.get("invalid_check_every_n_cycles", 360)
-        self.count_down = self.count_down_before_recheck
+        # threads mode: stopped workers still finishing a poll, reaped from the watcher loop
+        self.stopping_threads = {}  # type: dict[str, DeviceWorker]
+        self.worker_stop_timeout = config.get("worker_stop_timeout", 1)
+        # failing devices are quarantined by their CircuitBreaker and re-probed with backoff, at most
+        # max_concurrent_probes at a time, instead of restarting every invalid device at once
+        breaker_config = config.get("circuit_breaker", {})
+        self.breaker_settings = {
+            "failure_threshold": config.get("max_device_failures", 5),
+            "base_backoff": breaker_config.get("base_backoff", 30),
+            "max_backoff": breaker_config.get("max_backoff", 3600),
+            "jitter": breaker_config.get("jitter", 0.2),
+        }
+        self.probe_budget = ProbeBudget(breaker_config.get("max_concurrent_probes", 4))
+        self.probe_check_interval = breaker_config.get("probe_check_interval", 1)
+        self.next_probe_check = 0
+        self.breakers = {}  # type: dict[str, CircuitBreaker]
+        metrics.quarantined_devices.set_function(
+            lambda: sum(1 for breaker in list(self.breakers.values()) if breaker.state != BreakerState.CLOSED)
+        )
+        metrics.probes_in_flight.set_function(lambda: self.probe_budget.in_use)
         self.registry = None
-        self.broker = MessageBroker()
+        # DeviceEvents published by the registry, the watcher reacts to these instead of rescanning
+        self.events = Queue()
+        self.broker = MessageBroker(config=config)
+        self.poll_interval = config.get("poll_interval", 5)
+        self.publish_batches = config.get("publish_batches", False)
+        self.content_type = WIRE_FORMATS[config.get("wire_format", "json")]
+        # "all" publishes every reading, "change_only" only readings that changed plus keyframes
+        self.publish_mode = config.get("publish_mode", "all")
+        self.keyframe_interval = config.get("keyframe_interval", 300)
+        # when enabled each device's poll interval speeds up while its counters move and backs off when idle
+        self.adaptive_polling = config.get("adaptive_polling", {})
+        # "threads" runs one DeviceWorker thread per device, "async" runs every device as a
+        # coroutine on the broker's event loop, "scheduled" puts every device on one timing wheel
+        # and runs due polls on a shared thread pool
+        self.polling_engine = config.get("polling_engine", "threads")
+        # per device settings keyed by mac, e.g. a slower poll_interval for one device
+        self.device_overrides = {
+            mac.lower(): settings or {} for mac, settings in (config.get("device_overrides") or {}).items()
+        }
+        self.config = config
+        self.poller = None
+        self.scheduler = None
 
     def run(self):
         logger.info("Watcher loop starting")
         self.registry = get_registry()
         self.broker.start_and_wait()
+        if self.polling_engine == "async":
+            self.poller = AsyncDevicePoller(self.config, self.broker.loop)
+            logger.info(f"Using async polling engine, max concurrency {self.poller.max_concurrency}")
+        elif self.polling_engine == "scheduled":
+            self.scheduler = PollScheduler(self.config)
+            self.scheduler.start()
+        self.registry.subscribe(self.events.put)
+        # one full pass for the devices loaded from the database, after that only events
+        self.manage_device_threads()
         while self.running:
-            self.update_recheck_flag()
-            self.manage_device_threads()
-            self.recheck_invalid_devices = False
-            time.sleep(self.check_interval)
-            
-    def update_recheck_flag(self):
-        self.count_down -= 1
-        if self.count_down <= 0:
-            self.recheck_invalid_devices = True
-            self.count_down = self.count_down_before_recheck
+            timeout = max(0, self.next_probe_check - time.monotonic())
+            try:
+                event = self.events.get(timeout=timeout)
+                self.handle_event(event)
+            except Empty:
+                pass
+            if time.monotonic() >= self.next_probe_check:
+                self.probe_quarantined_devices()
+                self.next_probe_check = time.monotonic() + self.probe_check_interval
+            self.reap_stopped_workers()
+
+    def handle_event(self, event):
+        mac = event.mac
+        logger.debug(f"Device event {event.type.value} for {mac}")
+        if event.type in (DeviceEventType.ADDED, DeviceEventType.VALIDATED):
+            if mac not in self.device_threads:
+                device = self.registry.get_device(mac)
+                if device is not None:
+                    self.start_worker(device)
+        elif event.type == DeviceEventType.INVALIDATED:
+            if mac in self.device_threads:
+                logger.debug(f"Found Invalid Device {mac}.  REALLY KILLING IT !!")
+                self.stop_worker_for_device(mac)
+        elif event.type == DeviceEventType.IP_CHANGED:
+            # restart so the worker logs in against the new address
+            if mac in self.device_threads:
+                self.stop_worker_for_device(mac)
+                device = self.registry.get_device(mac)
+                if device is not None and device["valid"]:
+                    self.start_worker(device)
+
+    def breaker_for(self, mac):
+        breaker = self.breakers.get(mac)
+        if breaker is None:
+            breaker = CircuitBreaker(self.probe_budget, **self.breaker_settings)
+            self.breakers[mac] = breaker
+        return breaker
+
+    def probe_quarantined_devices(self):
+        # starts a single HALF_OPEN probe worker for quarantined devices whose backoff has passed
+        for mac, breaker in list(self.breakers.items()):
+            if mac in self.device_threads or not breaker.try_probe():
+                continue
+            device = self.registry.get_device(mac)
+            if device is None:
+                breaker.abandon_probe()
+                del self.breakers[mac]
+                continue
+            logger.info(f"Probing quarantined device {mac}")
+            self.start_worker(device)
 
     def manage_device_threads(self):
 # ************* ACCESS SHARED DEVICE REGISTRY ******************
@@ -45,38 +148,111 @@ class WatcherThread(threading.Thread):
             mac = device["mac"]
             logger.debug(f"Checking device {mac} is still valid")
             is_valid = device["valid"]
-            if is_valid or self.recheck_invalid_devices:
+            if is_valid:
                 if mac not in self.device_threads:
-                    validate = self.registry.get_handle_to_self_validate(mac)
-                    invalidate = self.registry.get_handle_to_self_invalidate(mac)
-                    update_device_field = self.registry.get_handle_to_update_device_field(mac)
-                    publish = self.broker.get_handle_to_publisher(mac)
-                    self.start_worker_for_device(
-                        device, 
-                        validate, 
-                        invalidate, 
-                        update_device_field, 
-                        publish
-                    )
+                    self.start_worker(device)
             else: # kill threads that are no longer valid 
                 if mac in self.device_threads:
                     logger.debug(f"Found Invalid Device {mac}.  REALLY KILLING IT !!")
                     self.stop_worker_for_device(mac)
+                # invalid devices from the database wait out a jittered backoff like any other
+                # quarantined device so they don't all get probed together at startup
+                self.breaker_for(mac).quarantine()
 
     def stop(self):
         self.running = False
+        if self.poller is not None:
+            self.poller.stop()
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        # spills whatever hasn't been published yet to the outbox
+        self.broker.stop()
+
+    def device_setting(self, mac, key, default):
+        return self.device_overrides.get(mac.lower(), {}).get(key, default)
 
     # Individual device thread management
+    def start_worker(self, device):
+        mac = device["mac"]
+        validate = self.registry.get_handle_to_self_validate(mac)
+        invalidate = self.registry.get_handle_to_self_invalidate(mac)
+        update_device_field = self.registry.get_handle_to_update_device_field(mac)
+        publish = self.broker.get_handle_to_publisher(mac, threadsafe=self.poller is None)
+        self.start_worker_for_device(
+            device,
+            validate,
+            invalidate,
+            update_device_field,
+            publish
+        )
+
     def start_worker_for_device(self, device, validate, invalidate, update_device_field, publish):
         mac = device["mac"]
-        thread = DeviceWorker(device, validate, invalidate, update_device_field, publish)
-        thread.start()
+        # registry records are immutable, the worker keeps its own working copy
+        device = dict(device)
+        slots = self.device_setting(mac, "slots", None)
+        if slots:
+            device["slots"] = slots  # I/O slots the scraper reads, see device/utils/scraper_registry.py
+        change_filter = None
+        if self.publish_mode == "change_only":
+            change_filter = ChangeFilter(keyframe_interval=self.keyframe_interval)
+        poll_interval = self.device_setting(mac, "poll_interval", self.poll_interval)
+        adaptive_interval = None
+        if self.adaptive_polling.get("enabled", False):
+            adaptive_interval = AdaptiveInterval(
+                poll_interval,
+                min_interval=self.adaptive_polling.get("min_interval", 1),
+                max_interval=self.adaptive_polling.get("max_interval", 60),
+                speedup=self.adaptive_polling.get("speedup", 0.5),
+                backoff=self.adaptive_polling.get("backoff", 1.25),
+            )
+        thread = DeviceWorker(
+            device,
+            validate,
+            invalidate,
+            update_device_field,
+            publish,
+            poll_interval=poll_interval,
+            publish_batches=self.publish_batches,
+            content_type=self.content_type,
+            change_filter=change_filter,
+            adaptive_interval=adaptive_interval,
+            breaker=self.breaker_for(mac),
+        )
+        if self.poller is not None:
+            self.poller.start_device(thread)
+        elif self.scheduler is not None:
+            self.scheduler.add(thread)
+        else:
+            stopping = self.stopping_threads.pop(mac, None)
+            if stopping is not None:
+                # sessions are keyed by mac, the old worker must not close them under the new one
+                stopping.owns_session = False
+            thread.start()
         self.device_threads[mac] = thread
 
     def stop_worker_for_device(self, mac):
         thread = self.device_threads[mac]
-        thread.stop()
-        thread.join()
+        if self.poller is not None:
+            self.poller.stop_device(thread)
+        elif self.scheduler is not None:
+            self.scheduler.remove(thread)
+        else:
+            # a worker in the middle of a poll can take its login/scrape deadlines to notice, don't
+            # hold up the event loop for that. Whatever hasn't exited yet is reaped later
+            thread.stop()
+            thread.join(timeout=self.worker_stop_timeout)
+            if thread.is_alive():
+                logger.warning(f"Worker for {mac} still finishing its poll, reaping it later")
+                self.stopping_threads[mac] = thread
         del self.device_threads[mac]
+        if mac in self.breakers:
+            self.breakers[mac].abandon_probe()
         logger.debug(f"Found Invalid Device {mac}.  FINISHED KILLING IT !!")
         logger.debug(f"{self.device_threads}")
+
+    def reap_stopped_workers(self):
+        for mac, thread in list(self.stopping_threads.items()):
+            if not thread.is_alive():
+                del self.stopping_threads[mac]
+                logger.debug(f"Worker for {mac} exited")
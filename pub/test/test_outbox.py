@@ -0,0 +1,96 @@
+import os
+import tempfile
+import unittest
+from utils.outbox import Outbox, DROP_OLDEST
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _corrupt(self, outbox, segment, offset):
+        # flip a byte inside the body of the record at offset so its crc no longer matches
+        with open(outbox._segment_path(segment), "r+b") as f:
+            f.seek(offset + 8)
+            byte = f.read(1)
+            f.seek(offset + 8)
+            f.write(bytes([byte[0] ^ 0xFF]))
+
+    def test_pop_returns_records_in_order(self):
+        outbox = Outbox(self.directory)
+        for i in range(5):
+            outbox.append("device.aa", f"m{i}".encode(), {"n": str(i)})
+        self.assertEqual(len(outbox), 5)
+        records = outbox.pop(10)
+        self.assertEqual([payload for _, payload, _ in records], [b"m0", b"m1", b"m2", b"m3", b"m4"])
+        self.assertEqual(records[0][2], {"n": "0"})
+        self.assertEqual(len(outbox), 0)
+        outbox.close()
+
+    def test_corrupt_record_drops_rest_of_segment(self):
+        # small segments so the first three records fill one segment and the rest go to the next
+        outbox = Outbox(self.directory, segment_bytes=100)
+        record_size = None
+        for i in range(6):
+            outbox.append("device.aa", f"m{i}".encode())
+            if record_size is None:
+                record_size = outbox.size_bytes()
+        first = min(outbox._segments)
+        self.assertEqual(outbox._segments[first][1], 100 // record_size)
+        per_segment = outbox._segments[first][1]
+        # second record of the first segment is corrupt, it and the records after it are lost
+        self._corrupt(outbox, first, record_size)
+        records = outbox.pop(10)
+        self.assertEqual(records[0][1], b"m0")
+        self.assertEqual(len(records), 6 - per_segment + 1)
+        self.assertEqual(outbox.dropped, per_segment - 1)
+        self.assertEqual(len(outbox), 0)
+        self.assertEqual(outbox.pop(10), [])
+        outbox.close()
+
+    def test_corrupt_record_in_writer_segment(self):
+        outbox = Outbox(self.directory)
+        for i in range(3):
+            outbox.append("device.aa", f"m{i}".encode())
+        record_size = outbox.size_bytes() // 3
+        self._corrupt(outbox, outbox._writer_segment, record_size)
+        self.assertEqual([payload for _, payload, _ in outbox.pop(10)], [b"m0"])
+        self.assertEqual(outbox.dropped, 2)
+        self.assertEqual(len(outbox), 0)
+        # records appended after the corrupt tail are still delivered
+        outbox.append("device.aa", b"m3")
+        self.assertEqual(len(outbox), 1)
+        self.assertEqual([payload for _, payload, _ in outbox.pop(10)], [b"m3"])
+        outbox.close()
+
+    def test_drop_oldest_counts_dropped_segment(self):
+        outbox = Outbox(self.directory, segment_bytes=100, max_bytes=200, drop_policy=DROP_OLDEST)
+        for i in range(20):
+            self.assertTrue(outbox.append("device.aa", f"m{i}".encode()))
+        self.assertGreater(outbox.dropped, 0)
+        self.assertEqual(len(outbox) + outbox.dropped, 20)
+        records = outbox.pop(100)
+        self.assertEqual(len(records) + outbox.dropped, 20)
+        self.assertEqual(records[-1][1], b"m19")
+        self.assertEqual(len(outbox), 0)
+        outbox.close()
+
+    def test_recovers_after_restart(self):
+        outbox = Outbox(self.directory)
+        for i in range(4):
+            outbox.append("device.aa", f"m{i}".encode())
+        outbox.pop(1)
+        outbox.close()
+        outbox = Outbox(self.directory)
+        self.assertEqual(len(outbox), 3)
+        self.assertEqual([payload for _, payload, _ in outbox.pop(10)], [b"m1", b"m2", b"m3"])
+        outbox.close()
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "cursor")))
+
+
+if __name__ == "__main__":
+    unittest.main()
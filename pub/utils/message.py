@@ -1,6 +1,6 @@
 from enum import Enum
-from dataclasses import dataclass, asdict
-from typing import Optional
+from dataclasses import dataclass, asdict, field
+from typing import Optional, List
 import json
 
 class Product(Enum):
@@ -57,6 +57,9 @@ class TelemetryMessage:
     estimated_pieces: Optional[int] = None
     rfid: Optional[str] = None
     dry_time_seconds: Optional[int] = None
+    # set when the publisher aggregated this channel at the edge: value is then the sum of the
+    # counter deltas over the last window_seconds rather than the raw counter reading
+    window_seconds: Optional[int] = None
 
     def to_bytes(self) -> bytes:
         # Convert Enums to values for serialization
@@ -72,14 +75,10 @@ class TelemetryMessage:
 
     @staticmethod
     def from_bytes(data: bytes) -> "TelemetryMessage":
-        d = json.loads(data.decode("utf-8"))
-
-        def safe_enum(enum_class, value):
-            try:
-                return enum_class(value) if value is not None else None
-            except ValueError:
-                return None
+        return TelemetryMessage.from_dict(json.loads(data.decode("utf-8")))
 
+    @staticmethod
+    def from_dict(d: dict) -> "TelemetryMessage":
         return TelemetryMessage(
             timestamp=d["timestamp"],
             source_mac=d["source_mac"],
@@ -97,5 +96,90 @@ class TelemetryMessage:
             estimated_pieces=d.get("estimated_pieces"),
             rfid=d.get("rfid"),
             dry_time_seconds=d.get("dry_time_seconds"),
+            window_seconds=d.get("window_seconds"),
         )
 
+# Every channel read in one scrape shares the same timestamp, mac and ip, so a batch sends that
+# header once and only the per channel fields for each reading. Readings only carry fields that
+# are set, enums are sent as their values like TelemetryMessage.
+READING_FIELDS = (
+    "source_name", "product", "zone", "machine", "machine_stage", "event_type", "units",
+    "value", "data_field_index", "pieces", "estimated_pieces", "rfid", "dry_time_seconds",
+    "window_seconds",
+)
+ENUM_FIELDS = {
+    "product": Product,
+    "zone": Zone,
+    "machine": Machine,
+    "machine_stage": MachineStage,
+    "event_type": EventType,
+}
+
+@dataclass
+class TelemetryBatchMessage:
+    timestamp: int
+    source_mac: str
+    source_ip: str
+    readings: List[TelemetryMessage] = field(default_factory=list)
+
+    @staticmethod
+    def from_messages(messages: List[TelemetryMessage]) -> "TelemetryBatchMessage":
+        if not messages:
+            raise ValueError("Cannot build a batch from no messages")
+        first = messages[0]
+        for msg in messages:
+            if (msg.timestamp, msg.source_mac, msg.source_ip) != (first.timestamp, first.source_mac, first.source_ip):
+                raise ValueError("All messages in a batch must share timestamp, source_mac and source_ip")
+        return TelemetryBatchMessage(
+            timestamp=first.timestamp,
+            source_mac=first.source_mac,
+            source_ip=first.source_ip,
+            readings=list(messages),
+        )
+
+    def to_messages(self) -> List[TelemetryMessage]:
+        return self.readings
+
+    def to_bytes(self) -> bytes:
+        readings = []
+        for msg in self.readings:
+            reading = {}
+            for name in READING_FIELDS:
+                value = getattr(msg, name)
+                if value is None:
+                    continue
+                reading[name] = value.value if name in ENUM_FIELDS else value
+            readings.append(reading)
+        d = {
+            "type": "batch",
+            "timestamp": self.timestamp,
+            "source_mac": self.source_mac,
+            "source_ip": self.source_ip,
+            "readings": readings,
+        }
+        return json.dumps(d, separators=(",", ":")).encode("utf-8")
+
+    @staticmethod
+    def from_dict(d: dict) -> "TelemetryBatchMessage":
+        header = {
+            "timestamp": d["timestamp"],
+            "source_mac": d["source_mac"],
+            "source_ip": d["source_ip"],
+        }
+        return TelemetryBatchMessage(
+            readings=[TelemetryMessage.from_dict({**reading, **header}) for reading in d.get("readings", [])],
+            **header,
+        )
+
+def safe_enum(enum_class, value):
+    try:
+        return enum_class(value) if value is not None else None
+    except ValueError:
+        return None
+
+def decode_telemetry(data: bytes) -> List[TelemetryMessage]:
+    # Accepts both a single TelemetryMessage and a TelemetryBatchMessage payload
+    d = json.loads(data.decode("utf-8"))
+    if d.get("type") == "batch":
+        return TelemetryBatchMessage.from_dict(d).to_messages()
+    return [TelemetryMessage.from_dict(d)]
@@ -1,16 +1,41 @@
 import asyncio
 import threading
+import uuid
 from asyncio import Queue
 import nats
 from utils.logging import setup_logger
+from utils import metrics
+from utils.outbox import Outbox
 
 logger = setup_logger(__name__)
 
 class MessageBroker(threading.Thread):
-    def __init__(self):
+    def __init__(self, config: dict = None):
         super().__init__()
+        broker_config = (config or {}).get("broker", {})
         self.daemon = True
-        self.queue = Queue()
+        # bounded in memory, anything that doesn't fit (or fails to publish) goes to the on-disk outbox
+        self.queue = Queue(maxsize=broker_config.get("queue_maxsize", 10000))
+        self.outbox = Outbox(
+            broker_config.get("outbox_dir", "db/data/outbox"),
+            segment_bytes=broker_config.get("outbox_segment_bytes", 16 * 1024 * 1024),
+            max_bytes=broker_config.get("outbox_max_bytes", 256 * 1024 * 1024),
+            drop_policy=broker_config.get("outbox_drop_policy", "drop_oldest"),
+            fsync=broker_config.get("outbox_fsync", False),
+        )
+        self.replay_interval = broker_config.get("outbox_replay_interval", 1)
+        # publishes are pipelined: up to max_in_flight are sent and waiting for their PubAck at once
+        self.max_in_flight = broker_config.get("max_in_flight", 64)
+        self.publish_retries = broker_config.get("publish_retries", 3)
+        self.retry_backoff = broker_config.get("retry_backoff", 0.5)
+        self.in_flight = 0
+        self._publishing = {}  # publish tasks waiting for their PubAck, a dict to keep publish order
+        self._workers = []
+        metrics.publish_in_flight.set_function(lambda: self.in_flight)
+        metrics.publish_queue_depth.set_function(lambda: self.queue.qsize())
+        metrics.outbox_pending.set_function(lambda: len(self.outbox))
+        metrics.outbox_bytes.set_function(lambda: self.outbox.size_bytes())
+        metrics.outbox_dropped.set_function(lambda: self.outbox.dropped)
         self.loop = asyncio.new_event_loop()
         self.nc = None
         self.js = None
@@ -27,7 +52,8 @@ class MessageBroker(threading.Thread):
             self.loop.close()
 
     async def _start(self):
-        self.nc = await nats.connect("nats://localhost:4222")
+        # keep reconnecting forever, the outbox holds messages while the broker is away
+        self.nc = await nats.connect("nats://localhost:4222", max_reconnect_attempts=-1)
         self.js = self.nc.jetstream()
         await self.js.add_stream(name="device_stream", subjects=["device.>"])
         try:
@@ -38,36 +64,140 @@ class MessageBroker(threading.Thread):
                 logger.info("JetStream stream 'device_stream' already exists.")
             else:
                 logger.error(f"Error creating JetStream stream: {e}")
-        asyncio.create_task(self._publish_worker())
+        self._workers = [
+            asyncio.create_task(self._publish_worker()),
+            asyncio.create_task(self._replay_worker()),
+        ]
 
     async def _close(self):
-        await self.nc.drain()
+        for task in self._workers:
+            task.cancel()
+        # give publishes already on the wire a moment for their PubAck, the rest go to the outbox
+        if self._publishing:
+            await asyncio.wait(list(self._publishing), timeout=self.retry_backoff * 4)
+        for task in list(self._publishing):
+            task.cancel()
+        await asyncio.gather(*self._workers, *self._publishing, return_exceptions=True)
+        if self.nc is not None:
+            try:
+                await self.nc.drain()
+            except Exception as e:
+                logger.error(f"Draining the NATS connection failed: {e}")
+        # whatever is still queued in memory is kept on disk for the next start, the outbox is
+        # closed last so nothing spilled while shutting down is lost
+        while not self.queue.empty():
+            self._spill(self.queue.get_nowait())
+        self.outbox.close()
+
+    def stop(self):
+        # queued and unacknowledged messages are spilled to the outbox by _close once the loop stops
+        logger.info("Stopping message broker")
+        self.loop.call_soon_threadsafe(self.loop.stop)
 
     def start_and_wait(self):
         self.start()
         self._started.wait()  # Block until event loop is running
 
-    def publish(self, subject: str, message: bytes):
+    def publish(self, subject: str, message: bytes, headers: dict = None):
         # Safe to call from any thread
         logger.info(f"trying to published to subject: {subject}, Message: {message}")
-        asyncio.run_coroutine_threadsafe(self.queue.put((subject, message)), self.loop)
+        try:
+            self.loop.call_soon_threadsafe(self._enqueue, (subject, message, headers))
+        except RuntimeError:
+            # loop already closed, a worker still finishing its poll during shutdown
+            logger.warning(f"Broker stopped, dropped message for {subject}")
+
+    def publish_nowait(self, subject: str, message: bytes, headers: dict = None):
+        # Only call from the broker's own event loop (e.g. the async device poller)
+        self._enqueue((subject, message, headers))
+
+    def _enqueue(self, item):
+        # Once anything is in the outbox new messages queue up behind it so they still go out in order.
+        # A message that fails every retry is spilled behind newer ones that already went out, so
+        # order across a publish failure isn't kept; the consumer skips readings older than the
+        # last one it has seen for the device, counters are cumulative so nothing is lost
+        if len(self.outbox) or self.queue.full():
+            self._spill(item)
+        else:
+            self.queue.put_nowait(item)
+
+    def _spill(self, item):
+        subject, message, headers = item
+        if not self.outbox.append(subject, message, headers):
+            logger.error(f"Outbox full, dropped message for {subject}")
+
+    async def _replay_worker(self):
+        while True:
+            free = self.queue.maxsize - self.queue.qsize()
+            if len(self.outbox) and free > 0 and self.nc.is_connected:
+                for item in self.outbox.pop(free):
+                    self.queue.put_nowait(item)
+                await asyncio.sleep(0)
+            else:
+                await asyncio.sleep(self.replay_interval)
+
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
 
     async def _publish_worker(self):
+        # Tasks are started in queue order so the publishes hit the wire in order, only the waits
+        # for their PubAcks overlap. The window semaphore bounds how many are outstanding.
+        window = asyncio.Semaphore(self.max_in_flight)
         while True:
-            subject, message = await self.queue.get()
+            subject, message, headers = await self.queue.get()
             try:
-                await self.js.publish(subject, message)
+                await window.acquire()
+            except asyncio.CancelledError:
+                self._spill((subject, message, headers))  # shutting down
+                raise
+            self.in_flight += 1
+            task = asyncio.create_task(self._publish_with_retry(subject, message, headers))
+            self._publishing[task] = None
+            def _done(_task):
+                self.in_flight -= 1
+                self._publishing.pop(_task, None)
+                window.release()
+            task.add_done_callback(_done)
+
+    async def _publish_with_retry(self, subject: str, message: bytes, headers: dict = None):
+        # Nats-Msg-Id lets JetStream drop the duplicate if a retried publish had actually been stored
+        headers = dict(headers or {})
+        headers.setdefault("Nats-Msg-Id", uuid.uuid4().hex)
+        for attempt in range(self.publish_retries + 1):
+            try:
+                await self.js.publish(subject, message, headers=headers)
+                metrics.published_total.inc()
                 logger.info(f"Published Message: {message}")
+                return True
+            except asyncio.CancelledError:
+                # shutting down before the PubAck, the Nats-Msg-Id dedupes it if it was stored
+                self._spill((subject, message, headers))
+                raise
             except Exception as e:
-                logger.error(f"Publish failed: {e}")
+                if attempt == self.publish_retries:
+                    metrics.publish_failures_total.inc()
+                    logger.error(f"Publish failed after {attempt + 1} attempts, moving to outbox: {e}")
+                    self._spill((subject, message, headers))
+                    return False
+                metrics.publish_retries_total.inc()
+                logger.warning(f"Publish attempt {attempt + 1} failed, retrying: {e}")
+            try:
+                await asyncio.sleep(self.retry_backoff * (2 ** attempt))
+            except asyncio.CancelledError:
+                self._spill((subject, message, headers))
+                raise
 
     def normalize_mac(self, mac: str) -> str:
         return mac.replace(":", "").lower()
 
-    def get_handle_to_publisher(self, mac: str):
+    def get_handle_to_publisher(self, mac: str, threadsafe: bool = True):
         norm_mac = self.normalize_mac(mac)
         subject = f"device.{norm_mac}"
-        def publish_message(msg: bytes):
-            self.publish(subject, msg)
+        if not threadsafe:
+            def publish_message_nowait(msg: bytes, headers: dict = None):
+                self.publish_nowait(subject, msg, headers)
+            return publish_message_nowait
+        def publish_message(msg: bytes, headers: dict = None):
+            self.publish(subject, msg, headers)
         return publish_message
 
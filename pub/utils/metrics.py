@@ -0,0 +1,112 @@
+# utils/metrics.py
+# Prometheus metrics for the publisher. Metrics are always recorded, the http endpoint is only
+# started when metrics_port is set in config.yaml.
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from utils.logging import setup_logger
+
+logger = setup_logger(__name__)
+
+publish_in_flight = Gauge(
+    "publisher_in_flight",
+    "JetStream publishes sent and still waiting for their PubAck",
+)
+publish_queue_depth = Gauge(
+    "publisher_queue_depth",
+    "Messages waiting in the MessageBroker queue",
+)
+published_total = Counter(
+    "publisher_published_total",
+    "Messages acknowledged by JetStream",
+)
+publish_retries_total = Counter(
+    "publisher_publish_retries_total",
+    "Publish attempts retried after a failed or missing PubAck",
+)
+publish_failures_total = Counter(
+    "publisher_publish_failures_total",
+    "Messages that could not be published after all retries",
+)
+
+outbox_pending = Gauge(
+    "publisher_outbox_pending",
+    "Messages stored in the on-disk outbox waiting to be replayed",
+)
+outbox_bytes = Gauge(
+    "publisher_outbox_bytes",
+    "Bytes used by outbox segment files",
+)
+outbox_dropped = Gauge(
+    "publisher_outbox_dropped",
+    "Messages dropped because the outbox reached its disk cap",
+)
+
+scheduled_devices = Gauge(
+    "poller_scheduled_devices",
+    "Devices on the poll scheduler's timing wheel",
+)
+poll_schedule_lag = Gauge(
+    "poller_schedule_lag_seconds_last",
+    "How late the most recently dispatched poll started compared to its due time",
+)
+poll_schedule_lag_seconds = Histogram(
+    "poller_schedule_lag_seconds",
+    "How late polls start compared to their due time",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+)
+poll_skipped_total = Counter(
+    "poller_skipped_polls_total",
+    "Polls skipped because the device's previous poll was still running (busy) or ran past later due times (overrun)",
+    ["reason"],
+)
+
+quarantined_devices = Gauge(
+    "poller_quarantined_devices",
+    "Devices with an open or half-open circuit breaker",
+)
+probes_in_flight = Gauge(
+    "poller_probes_in_flight",
+    "Quarantined devices currently being re-probed",
+)
+
+device_operation_seconds = Histogram(
+    "device_operation_seconds",
+    "Time taken by device logins and scrapes, including the ones that missed their deadline",
+    ["operation"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+)
+device_operation_last_seconds = Gauge(
+    "device_operation_last_seconds",
+    "Duration of the most recent operation per device, to find the slow ones",
+    ["mac", "operation"],
+)
+device_deadline_misses_total = Counter(
+    "device_deadline_misses_total",
+    "Device operations that ran past their configured deadline",
+    ["mac", "operation"],
+)
+device_deadline_retries_total = Counter(
+    "device_deadline_retries_total",
+    "Operations retried on a fresh connection after missing their deadline",
+    ["operation"],
+)
+
+discovery_attempt_seconds = Histogram(
+    "discovery_attempt_seconds",
+    "Time taken by one credential discovery candidate (login plus scraper check)",
+    ["outcome"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+)
+
+discovery_fingerprints_total = Counter(
+    "discovery_fingerprints_total",
+    "Fingerprint lookups during credential discovery by result (hit, miss, stale)",
+    ["result"],
+)
+
+
+def start_metrics_server(config: dict):
+    port = config.get("metrics_port")
+    if port is None:
+        return
+    start_http_server(int(port))
+    logger.info(f"Serving prometheus metrics on :{port}")
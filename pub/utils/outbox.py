@@ -0,0 +1,265 @@
+# utils/outbox.py
+# Append-only on-disk outbox for messages the MessageBroker could not hand to JetStream (queue full,
+# broker down, publish failed after retries). Records are written to numbered segment files, read back
+# through mmap in the order they were appended, and a segment is deleted once fully replayed.
+# The read position is kept in a small cursor file so the outbox survives a restart.
+#
+# Record layout: body length (uint32) | crc32 of body (uint32) | body
+# body: subject length (uint16) | subject | headers length (uint32) | headers json | payload
+
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from typing import List, Optional, Tuple
+from utils.logging import setup_logger
+
+logger = setup_logger(__name__)
+
+RECORD_HEADER = struct.Struct(">II")
+SUBJECT_LEN = struct.Struct(">H")
+HEADERS_LEN = struct.Struct(">I")
+CURSOR = struct.Struct(">QQ")
+SEGMENT_SUFFIX = ".seg"
+CURSOR_FILE = "cursor"
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+
+Record = Tuple[str, bytes, Optional[dict]]
+
+
+def encode_record(subject: str, message: bytes, headers: Optional[dict]) -> bytes:
+    raw_subject = subject.encode("utf-8")
+    raw_headers = json.dumps(headers, separators=(",", ":")).encode("utf-8") if headers else b""
+    body = b"".join([
+        SUBJECT_LEN.pack(len(raw_subject)), raw_subject,
+        HEADERS_LEN.pack(len(raw_headers)), raw_headers,
+        message,
+    ])
+    return RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def decode_body(body) -> Record:
+    (subject_len,) = SUBJECT_LEN.unpack_from(body, 0)
+    offset = SUBJECT_LEN.size
+    subject = bytes(body[offset:offset + subject_len]).decode("utf-8")
+    offset += subject_len
+    (headers_len,) = HEADERS_LEN.unpack_from(body, offset)
+    offset += HEADERS_LEN.size
+    headers = json.loads(bytes(body[offset:offset + headers_len])) if headers_len else None
+    offset += headers_len
+    return subject, bytes(body[offset:]), headers
+
+
+def read_record(buf, offset: int, size: int):
+    # Returns (record, next_offset), or None at the end of the valid data (including a torn write)
+    if offset + RECORD_HEADER.size > size:
+        return None
+    length, crc = RECORD_HEADER.unpack_from(buf, offset)
+    start = offset + RECORD_HEADER.size
+    end = start + length
+    if end > size:
+        return None
+    body = buf[start:end]
+    if zlib.crc32(body) != crc:
+        return None
+    return decode_body(body), end
+
+
+class Outbox:
+    def __init__(self, directory: str, segment_bytes: int = 16 * 1024 * 1024,
+                 max_bytes: int = 256 * 1024 * 1024, drop_policy: str = DROP_OLDEST, fsync: bool = False):
+        if drop_policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError(f"Unknown outbox drop policy {drop_policy}")
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.drop_policy = drop_policy
+        self.fsync = fsync
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._segments = {}  # key: segment number, value: [size in bytes, records in segment]
+        self._pending = 0
+        self._writer = None
+        self._writer_segment = None
+        self._reader_map = None
+        self._reader_map_size = 0
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+
+    # ---- startup -------------------------------------------------------------------------
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:016d}{SEGMENT_SUFFIX}")
+
+    def _recover(self):
+        numbers = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+        self._read_segment, self._read_offset = self._load_cursor()
+        for segment in numbers:
+            if segment < self._read_segment:
+                os.remove(self._segment_path(segment))  # fully replayed before the restart
+                continue
+            size, records = self._scan_segment(segment)
+            self._segments[segment] = [size, records]
+        if not self._segments:
+            self._read_segment = max(numbers, default=-1) + 1
+            self._read_offset = 0
+            self._segments[self._read_segment] = [0, 0]
+        if self._read_segment not in self._segments:
+            self._read_segment, self._read_offset = min(self._segments), 0
+        self._pending = sum(records for _, records in self._segments.values())
+        self._writer_segment = max(self._segments)
+        self._writer = open(self._segment_path(self._writer_segment), "ab")
+        if self._pending:
+            logger.warning(f"Outbox recovered {self._pending} unsent messages from {self.directory}")
+
+    def _scan_segment(self, segment: int):
+        # Counts the unread records and truncates a torn record left by a crash mid-append
+        path = self._segment_path(segment)
+        size = os.path.getsize(path)
+        offset = self._read_offset if segment == self._read_segment else 0
+        records = 0
+        if size:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                while True:
+                    result = read_record(buf, offset, size)
+                    if result is None:
+                        break
+                    offset = result[1]
+                    records += 1
+        if offset < size:
+            logger.warning(f"Truncating torn outbox segment {path} at {offset}")
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+            size = offset
+        return size, records
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE), "rb") as f:
+                return CURSOR.unpack(f.read(CURSOR.size))
+        except (OSError, struct.error):
+            return 0, 0
+
+    def _save_cursor(self):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(CURSOR.pack(self._read_segment, self._read_offset))
+        os.replace(tmp, path)
+
+    # ---- writing -------------------------------------------------------------------------
+
+    def __len__(self):
+        return self._pending
+
+    def size_bytes(self) -> int:
+        return sum(size for size, _ in self._segments.values())
+
+    def append(self, subject: str, message: bytes, headers: Optional[dict] = None) -> bool:
+        record = encode_record(subject, message, headers)
+        with self._lock:
+            if not self._make_room(len(record)):
+                self.dropped += 1
+                return False
+            size, _ = self._segments[self._writer_segment]
+            if size and size + len(record) > self.segment_bytes:
+                self._rotate()
+            self._writer.write(record)
+            self._writer.flush()
+            if self.fsync:
+                os.fsync(self._writer.fileno())
+            self._segments[self._writer_segment][0] += len(record)
+            self._segments[self._writer_segment][1] += 1
+            self._pending += 1
+            return True
+
+    def _rotate(self):
+        self._writer.close()
+        self._writer_segment += 1
+        self._segments[self._writer_segment] = [0, 0]
+        self._writer = open(self._segment_path(self._writer_segment), "ab")
+
+    def _make_room(self, record_size: int) -> bool:
+        while self.size_bytes() + record_size > self.max_bytes:
+            if self.drop_policy == DROP_NEWEST or self._read_segment == self._writer_segment:
+                return False
+            # drop_oldest: throw away the oldest whole segment
+            _, records = self._segments[self._read_segment]
+            logger.error(f"Outbox over {self.max_bytes} bytes, dropping {records} oldest messages")
+            self._delete_read_segment()
+        return True
+
+    # ---- reading -------------------------------------------------------------------------
+
+    def pop(self, max_records: int) -> List[Record]:
+        # Removes and returns up to max_records in the order they were appended
+        out = []
+        with self._lock:
+            while len(out) < max_records and self._pending:
+                size, _ = self._segments[self._read_segment]
+                if self._read_offset >= size:
+                    if self._read_segment == self._writer_segment:
+                        break
+                    self._delete_read_segment()
+                    continue
+                buf = self._map_reader(size)
+                result = read_record(buf, self._read_offset, size)
+                if result is None:
+                    # unreadable tail, skip the rest of this segment and everything still counted in it
+                    logger.error(f"Corrupt outbox record in segment {self._read_segment} at {self._read_offset}")
+                    self._read_offset = size
+                    self._drop_unread()
+                    continue
+                record, self._read_offset = result
+                self._segments[self._read_segment][1] -= 1
+                self._pending -= 1
+                out.append(record)
+            if out:
+                self._save_cursor()
+        return out
+
+    def _map_reader(self, size: int):
+        # the writer segment keeps growing, so it gets remapped when more has been appended
+        if self._reader_map is None or self._reader_map_size < size:
+            self._close_reader()
+            with open(self._segment_path(self._read_segment), "rb") as f:
+                self._reader_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._reader_map_size = size
+        return self._reader_map
+
+    def _close_reader(self):
+        if self._reader_map is not None:
+            self._reader_map.close()
+        self._reader_map = None
+        self._reader_map_size = 0
+
+    def _drop_unread(self):
+        # records of the read segment that will never be read, they are lost with it
+        records = self._segments[self._read_segment][1]
+        self._segments[self._read_segment][1] = 0
+        self._pending -= records
+        self.dropped += records
+
+    def _delete_read_segment(self):
+        self._drop_unread()
+        self._close_reader()
+        del self._segments[self._read_segment]
+        os.remove(self._segment_path(self._read_segment))
+        self._read_segment = min(self._segments)
+        self._read_offset = 0
+        self._save_cursor()
+
+    def close(self):
+        with self._lock:
+            self._close_reader()
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
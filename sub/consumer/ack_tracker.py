@@ -0,0 +1,75 @@
+# Tracks JetStream messages between delivery and the database commit of their rows, so a message is
+# only acked once everything it produced is committed (or rejected as poison by the writer), instead
+# of as soon as it was queued. A crash before the commit means the message is redelivered.
+# Only touched from the consumer's event loop thread.
+#
+# Messages are keyed by stream sequence, a redelivery of a message that is still pending takes over
+# the existing entry instead of getting a new one. With the AckAll policy one ack covers every earlier
+# message, so only the last message of the completed prefix is acked; with explicit acks every
+# completed message is acked, still in one go per committed batch.
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, List
+
+
+@dataclass
+class PendingDelivery:
+    msg: Any
+    outstanding: int  # rows queued for the writer and not committed (or dropped) yet
+
+    @property
+    def done(self):
+        return self.outstanding <= 0
+
+
+class AckTracker:
+    def __init__(self, ack_all: bool):
+        self.ack_all = ack_all
+        self._pending = OrderedDict()  # key: stream sequence, value: PendingDelivery
+
+    def __len__(self):
+        return len(self._pending)
+
+    def track(self, key: int, msg, rows: int):
+        entry = self._pending.get(key)
+        if entry is None:
+            self._pending[key] = PendingDelivery(msg, rows)
+            return
+        # redelivered before we acked it, keep its place in the order
+        entry.msg = msg
+        entry.outstanding += rows
+
+    def track_once(self, key: int, msg):
+        # for a single unit of work per message (the shard router), a redelivery only replaces the
+        # handle so one completion always finishes the entry
+        entry = self._pending.get(key)
+        if entry is None:
+            self._pending[key] = PendingDelivery(msg, 1)
+            return
+        entry.msg = msg
+
+    def rows_done(self, keys: List[int]):
+        # committed, or a poison row the writer can never write
+        for key in keys:
+            entry = self._pending.get(key)
+            if entry is not None:
+                entry.outstanding = max(0, entry.outstanding - 1)
+
+    def take_ready(self) -> list:
+        # Returns the messages to ack and forgets them
+        if self.ack_all:
+            last = None
+            while self._pending:
+                key, entry = next(iter(self._pending.items()))
+                if not entry.done:
+                    break
+                self._pending.popitem(last=False)
+                last = entry.msg
+            return [last] if last is not None else []
+        acks = []
+        for key, entry in list(self._pending.items()):
+            if entry.done:
+                acks.append(entry.msg)
+                del self._pending[key]
+        return acks
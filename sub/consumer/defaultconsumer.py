@@ -1,18 +1,27 @@
+import json
 import pprint
 import threading
 import time
 import asyncio
 import nats
+from queue import Full
+from nats.js.api import AckPolicy
+from nats.js.api import ConsumerConfig
+from nats.js.api import DeliverPolicy
 from dataclasses import dataclass
+from consumer.ack_tracker import AckTracker
 from db.utils.db_session import SessionLocal
 from db.repository.snapshot_repository import SnapshotRepository
 from utils.logging import setup_logger
 from utils.message import TelemetryMessage
+from utils.codec import decode_payload
+from utils.codec import CONTENT_TYPE_HEADER
 from utils.message import Product
 from utils.message import Zone
 from utils.message import Machine
 from utils.message import MachineStage
 from utils.message import EventType
+from utils import metrics
 
 logger = setup_logger(__name__)
 
@@ -21,6 +30,19 @@ class LastSeenInfo:
     timestamp: int
     value: int
 
+# Messages are acked only after every row they produced is committed by the DBWriteThread (it calls
+# rows_committed, or rows_failed for rows it dropped), until then they sit in self.acks. Queue items are
+# (TelemetryMessage, stream sequence of the message they came from).
+#
+# In push mode (the default) JetStream delivers one message per callback. In pull mode messages are
+# fetched fetch_batch at a time, waiting at most fetch_max_wait for a batch to fill, each batch is
+# decoded and queued as a unit and the next fetch only happens while fewer than max_in_flight
+# messages are waiting on the writer, so a slow Postgres slows down consumption instead of the
+# backlog moving into this process.
+#
+# The queue to the writer is bounded (writer.queue_size). When it is full the consumer waits for room
+# instead of buffering in memory: in pull mode that stops fetching, in push mode the callback doesn't
+# return and max_ack_pending caps how much JetStream pushes before the writer catches up.
 class DefaultConsumerThread(threading.Thread):
     def __init__(self, config, queue):
         super().__init__()
@@ -33,12 +55,28 @@ class DefaultConsumerThread(threading.Thread):
         self._started = threading.Event() # this is a thread safe flag
         self._running = threading.Event() # this is a thread safe flag
         self.last_seen: dict[str, list(LastSeenInfo)] = {}
+        consumer_config = config.get("consumer", {})
+        self.ack_policy = AckPolicy(consumer_config.get("ack_policy", "explicit"))
+        self.acks = AckTracker(ack_all=self.ack_policy == AckPolicy.ALL)
+        self.mode = consumer_config.get("mode", "push")
+        if self.mode not in ("push", "pull"):
+            raise ValueError(f"Unknown consumer mode {self.mode}")
+        self.fetch_batch = consumer_config.get("fetch_batch", 100)
+        self.fetch_max_wait = consumer_config.get("fetch_max_wait", 1.0)
+        self.max_in_flight = consumer_config.get("max_in_flight", 4 * self.fetch_batch)
+        # a push durable can't be fetched from, pull mode needs its own durable consumer
+        self.pull_durable = consumer_config.get("pull_durable", "device_pull_consumer")
+        self.max_ack_pending = consumer_config.get("max_ack_pending", 1000)
+        self.psub = None
+        self._room = None  # asyncio.Event, set while the writer has room for another batch
 
     def run(self):
         asyncio.set_event_loop(self.loop)
         self.loop.run_until_complete(self._start())
         self._started.set()
         self._running.set()
+        if self.psub is not None:
+            self.loop.create_task(self._fetch_loop())
         try:
             self.loop.run_forever()
         finally:
@@ -63,13 +101,31 @@ class DefaultConsumerThread(threading.Thread):
         while attempt_reconnect:
             logger.info(f"attempting to connect to nats-jetstream")
             try:
-                await self.js.subscribe(
-                    "device.>",
-                    durable="device_consumer",
-                    cb=self._handle_message,
-                    manual_ack=True,
-                    deliver_policy="all"  # or "new" depending on intent
-                )
+                if self.mode == "pull":
+                    self._room = asyncio.Event()
+                    self._room.set()
+                    deliver_policy, start_seq = await self._pull_start_position()
+                    self.psub = await self.js.pull_subscribe(
+                        "device.>",
+                        durable=self.pull_durable,
+                        config=ConsumerConfig(
+                            ack_policy=self.ack_policy,
+                            deliver_policy=deliver_policy,
+                            opt_start_seq=start_seq,
+                            max_ack_pending=self.max_ack_pending
+                        )
+                    )
+                    await self._check_consumer_config(self.psub)
+                else:
+                    sub = await self.js.subscribe(
+                        "device.>",
+                        durable="device_consumer",
+                        cb=self._handle_message,
+                        manual_ack=True,
+                        deliver_policy="all",  # or "new" depending on intent
+                        config=ConsumerConfig(ack_policy=self.ack_policy, max_ack_pending=self.max_ack_pending)
+                    )
+                    await self._check_consumer_config(sub)
                 await asyncio.sleep(5)
                 attempt_reconnect = False
             except Exception as e:
@@ -81,6 +137,87 @@ class DefaultConsumerThread(threading.Thread):
                 logger.error(f"connection to nats-jetstream failed, attempt reconnect: {attempt_reconnect}, attempt: {attempt}")
                 logger.exception(e)
 
+    async def _pull_start_position(self):
+        # A new pull durable picks up where the push durable stopped (its ack floor), otherwise
+        # switching modes would replay the whole stream and write every delta a second time.
+        # Only matters when the pull durable is created, an existing one keeps its position
+        stream = await self.js.find_stream_name_by_subject("device.>")
+        try:
+            await self.js.consumer_info(stream, self.pull_durable)
+            return DeliverPolicy.ALL, None
+        except nats.js.errors.NotFoundError:
+            pass
+        try:
+            push_info = await self.js.consumer_info(stream, "device_consumer")
+        except nats.js.errors.NotFoundError:
+            return DeliverPolicy.ALL, None  # fresh deployment, same as the push durable would do
+        start_seq = push_info.ack_floor.stream_seq + 1
+        logger.info(f"Creating pull durable {self.pull_durable} at stream sequence {start_seq}, after device_consumer's ack floor")
+        return DeliverPolicy.BY_START_SEQUENCE, start_seq
+
+    async def _fetch_loop(self):
+        logger.info(f"Fetching from {self.pull_durable} in batches of {self.fetch_batch}")
+        while self._running.is_set():
+            await self._room.wait()
+            try:
+                msgs = await self.psub.fetch(self.fetch_batch, timeout=self.fetch_max_wait)
+            except nats.errors.TimeoutError:
+                continue  # nothing arrived within fetch_max_wait
+            except Exception as e:
+                logger.error(f"Fetch from {self.pull_durable} failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            metrics.consumer_fetch_batch_size.observe(len(msgs))
+            await self._handle_batch(msgs)
+
+    def _update_room(self):
+        if self._room is None:
+            return
+        if len(self.acks) < self.max_in_flight:
+            self._room.set()
+        else:
+            self._room.clear()
+
+    async def _check_consumer_config(self, sub):
+        # an existing durable consumer keeps the config it was created with, ack the way the server expects
+        info = await sub.consumer_info()
+        if info.config.max_ack_pending != self.max_ack_pending:
+            logger.warning(f"Durable consumer uses max_ack_pending {info.config.max_ack_pending}, configured {self.max_ack_pending}. "
+                           f"Delete the consumer to change it")
+        if info.config.ack_policy != self.ack_policy:
+            logger.warning(f"Durable consumer uses ack policy {info.config.ack_policy}, configured {self.ack_policy}. "
+                           f"Delete the consumer to change it, acking with {info.config.ack_policy} for now")
+            self.acks.ack_all = info.config.ack_policy == AckPolicy.ALL
+
+    # Called from the DBWriteThread with the stream sequence of every row in a batch
+    def rows_committed(self, keys):
+        self.loop.call_soon_threadsafe(self._rows_done, keys)
+
+    def rows_failed(self, keys):
+        # Poison rows: invalid or rejected by postgres on their own, a redelivery would fail the same way
+        # so their messages are acked. The writer keeps retrying anything that failed for a transient
+        # reason and never reports it here, those messages stay unacked until their rows commit
+        logger.error(f"Writer rejected {len(keys)} poison rows, acking their messages without them")
+        metrics.consumer_poison_rows_total.inc(len(keys))
+        self.loop.call_soon_threadsafe(self._rows_done, keys)
+
+    def _rows_done(self, keys):
+        self.acks.rows_done(keys)
+        self.loop.create_task(self._send_acks())
+
+    async def _send_acks(self):
+        # one ack (AckAll) or one ack per message (explicit), all buffered into one flush by the client
+        acks = self.acks.take_ready()
+        try:
+            for msg in acks:
+                await msg.ack()
+        except Exception as e:
+            # whatever wasn't acked is redelivered after ack_wait
+            logger.error(f"Failed to ack {len(acks)} messages: {e}")
+        metrics.consumer_acks_total.inc(len(acks))
+        metrics.consumer_pending_acks.set(len(self.acks))
+        self._update_room()
+
     async def _close(self):
         # logger.info("Closing NATS connection...")
         if self.nc:
@@ -96,9 +233,10 @@ class DefaultConsumerThread(threading.Thread):
         # Signal the loop to stop
         self.loop.call_soon_threadsafe(_stop_loop)
 
-    def default_last_seen_list(self):
+    def default_last_seen_list(self, length=8):
         # returns a list of length 8, containing LastSeenInfo objects
-        return [LastSeenInfo(timestamp=0, value=0) for _ in range(8)]
+        # (get_last_seen_entry grows it for controllers with more channels)
+        return [LastSeenInfo(timestamp=0, value=0) for _ in range(length)]
 
     def add_last_seen_entry(self, key):
         if key in self.last_seen:
@@ -106,46 +244,54 @@ class DefaultConsumerThread(threading.Thread):
         else:
             self.last_seen[key] = self.default_last_seen_list()
 
-    def get_last_seen_entry(self, key):
+    def get_last_seen_entry(self, key, index=0):
         if key not in self.last_seen:
             self.add_last_seen_entry(key)
-        return self.last_seen.get(key)
+        entries = self.last_seen.get(key)
+        if index >= len(entries):
+            # multi slot controllers publish data_field_index past the default 8 channels
+            entries.extend(LastSeenInfo(timestamp=0, value=0) for _ in range(index + 1 - len(entries)))
+        return entries
     
     def reset_last_seen_entry(self, key):
-        self.last_seen[key] = self.default_last_seen_list()
+        self.last_seen[key] = self.default_last_seen_list(max(8, len(self.last_seen.get(key, []))))
 
     async def _handle_message(self, msg):
         if not self._running.is_set():
             return  # skip processing if we're shutting down
-        try:
-            subject = msg.subject
-            full_msg = TelemetryMessage.from_bytes(msg.data)
-            index = full_msg.data_field_index
-            current_msg = LastSeenInfo(timestamp=full_msg.timestamp, value=full_msg.value)
-
-            last_msg = self.get_last_seen_entry(subject)[index]
-
-            payload = 0
+        if await self._decode_message(msg) == 0:
+            await self._send_acks()
 
-            if current_msg.timestamp > last_msg.timestamp and current_msg.value < last_msg.value:
-                self.reset_last_seen_entry(subject)
-                self.get_last_seen_entry(subject)[index] = current_msg # even if current_msg.value is negative it's fine
+    async def _handle_batch(self, msgs):
+        for msg in msgs:
+            await self._decode_message(msg)
+        # acks whatever in the batch produced no rows, the rest is acked as the writer commits it
+        await self._send_acks()
 
-            if current_msg.timestamp > last_msg.timestamp and current_msg.value > last_msg.value:
-                payload = current_msg.value - last_msg.value
-                if payload > 50:
-                    payload = 1
+    def _message_key(self, msg):
+        return msg.metadata.sequence.stream
 
-            self.get_last_seen_entry(subject)[index] = current_msg # even if payload is zero update the timestamp
-            # logger.info(f"last message - TelemetryMessage:\n{pprint.pformat(vars(last_msg))}")
-            # logger.info(f"current message - TelemetryMessage:\n{pprint.pformat(vars(current_msg))}")
-
-            if payload > 0:
-                logger.info(f"\npayload: {payload}\n")
-                full_msg.value = payload
-                logger.info(f"POSTING TO QUEUE - TelemetryMessage:\n{pprint.pformat(vars(full_msg))}")
-                self.queue.put(full_msg)  # Put structured object on the queue
-            await msg.ack()
+    async def _decode_message(self, msg):
+        # queues the message's rows for the writer, returns how many or None when it couldn't be decoded
+        try:
+            subject = msg.subject
+            # a payload is either a single TelemetryMessage or a batch of every channel from one scrape,
+            # encoded as json or binary depending on the Content-Type header (sniffed if missing)
+            content_type = msg.headers.get(CONTENT_TYPE_HEADER) if msg.headers else None
+            key = self._message_key(msg)
+            rows = []
+            for full_msg in decode_payload(msg.data, content_type):
+                row = self._process_telemetry(subject, full_msg)
+                if row is not None:
+                    rows.append(row)
+            # acked once the writer committed its rows, right away when it produced none.
+            # Tracked before queueing, the writer can commit them before we're done here
+            self.acks.track(key, msg, len(rows))
+            metrics.consumer_pending_acks.set(len(self.acks))
+            self._update_room()
+            for row in rows:
+                await self._enqueue((row, key))
+            return len(rows)
         except json.JSONDecodeError as e:
             logger.error("Failed to decode JSON from TelemetryMessage:")
             logger.error(repr(msg.data))
@@ -160,6 +306,71 @@ class DefaultConsumerThread(threading.Thread):
             logger.exception(e)
 
 
+    async def _enqueue(self, item, queue=None):
+        # queue defaults to the writer queue, the shard router hands messages to its shards with this too
+        target = self.queue if queue is None else queue
+        try:
+            target.put_nowait(item)
+        except Full:
+            # writer is behind, wait for room without blocking the event loop so acks keep flowing.
+            # Rows still waiting at shutdown are dropped, their message was never acked and is redelivered
+            started = time.monotonic()
+            while self._running.is_set():
+                await asyncio.sleep(0.05)
+                try:
+                    target.put_nowait(item)
+                    break
+                except Full:
+                    continue
+            blocked = time.monotonic() - started
+            metrics.consumer_queue_blocked_seconds_total.inc(blocked)
+            logger.debug(f"Writer queue full, waited {blocked:.3f}s")
+        if queue is None:
+            metrics.writer_queue_depth.set(self.queue.qsize())
+
+    def _process_telemetry(self, subject, full_msg):
+        # returns the message to queue for the writer, None when there is nothing to write
+        if full_msg.window_seconds is not None:
+            # aggregated at the edge, value is already the sum of deltas over the window
+            if full_msg.value > 0:
+                logger.info(f"POSTING TO QUEUE - aggregated TelemetryMessage:\n{pprint.pformat(vars(full_msg))}")
+                return full_msg
+            return None
+        index = full_msg.data_field_index
+        current_msg = LastSeenInfo(timestamp=full_msg.timestamp, value=full_msg.value)
+
+        last_msg = self.get_last_seen_entry(subject, index)[index]
+
+        if current_msg.timestamp <= last_msg.timestamp:
+            # a retried or outbox replayed publish arriving after newer readings (or a duplicate).
+            # The counter is cumulative so the newer reading already covers it, storing it would
+            # move last_seen backwards and count the next delta twice
+            logger.debug(f"Ignoring stale reading for {subject}[{index}]: {current_msg.timestamp} <= {last_msg.timestamp}")
+            return None
+
+        payload = 0
+
+        if current_msg.timestamp > last_msg.timestamp and current_msg.value < last_msg.value:
+            self.reset_last_seen_entry(subject)
+            self.get_last_seen_entry(subject, index)[index] = current_msg # even if current_msg.value is negative it's fine
+
+        if current_msg.timestamp > last_msg.timestamp and current_msg.value > last_msg.value:
+            payload = current_msg.value - last_msg.value
+            if payload > 50:
+                payload = 1
+
+        self.get_last_seen_entry(subject, index)[index] = current_msg # even if payload is zero update the timestamp
+        # logger.info(f"last message - TelemetryMessage:\n{pprint.pformat(vars(last_msg))}")
+        # logger.info(f"current message - TelemetryMessage:\n{pprint.pformat(vars(current_msg))}")
+
+        if payload > 0:
+            logger.info(f"\npayload: {payload}\n")
+            full_msg.value = payload
+            logger.info(f"POSTING TO QUEUE - TelemetryMessage:\n{pprint.pformat(vars(full_msg))}")
+            return full_msg  # structured object goes on the queue
+        return None
+
+
 #session = SessionLocal()
 #snapshot_repo = SnapshotRepository(session)
 #consumer_name = "default"
@@ -0,0 +1,172 @@
+# Sharded mode (consumer.shards > 1): decoding, delta tracking and writing run in N shard processes
+# instead of one thread, so ingest isn't limited to one core.
+#
+# One router thread in the main process consumes the durable consumer (push or pull, same as
+# DefaultConsumerThread) and hands every message to the shard that owns its subject, picked by a
+# stable hash of the subject (device.<mac>). A device always lands on the same shard, so that
+# shard's last_seen holds the whole delta state of the device and sees its messages in order.
+# Shards report back the stream sequences whose rows are committed and the router acks them, with
+# AckAll that is the low watermark over every shard.
+#
+# The router only routes, it never looks at the payload. Each shard has its own writer queue and
+# DBWriteThread, its inbox is bounded (consumer.shard_inbox_size) so a slow shard pauses the router.
+
+import asyncio
+import multiprocessing
+import threading
+import zlib
+from dataclasses import dataclass
+from queue import Empty, Queue
+from typing import Optional
+from consumer.ack_tracker import AckTracker
+from consumer.defaultconsumer import DefaultConsumerThread
+from writer.dbwritethread import DBWriteThread
+from utils.logging import setup_logger
+from utils.metrics import start_metrics_server
+from utils import metrics
+
+logger = setup_logger(__name__)
+
+
+def shard_for(subject: str, shards: int) -> int:
+    # crc32 instead of hash(), which is salted differently in every process
+    return zlib.crc32(subject.encode()) % shards
+
+
+@dataclass
+class ShardMessage:
+    # what a shard gets of a JetStream message, acking stays with the router
+    subject: str
+    data: bytes
+    headers: Optional[dict]
+    seq: int
+
+
+class ShardRouterThread(DefaultConsumerThread):
+    def __init__(self, config):
+        super().__init__(config, queue=None)
+        consumer_config = config.get("consumer", {})
+        self.shards = consumer_config.get("shards", 1)
+        context = multiprocessing.get_context("spawn")
+        inbox_size = consumer_config.get("shard_inbox_size", 1000)
+        self.inboxes = [context.Queue(maxsize=inbox_size) for _ in range(self.shards)]
+        self.outbox = context.Queue()
+        self.processes = [
+            context.Process(target=run_shard, args=(config, index, self.inboxes[index], self.outbox), name=f"shard-{index}", daemon=True)
+            for index in range(self.shards)
+        ]
+        self.results_thread = threading.Thread(target=self._read_results, name="shard-results", daemon=True)
+
+    def start_and_wait(self):
+        for process in self.processes:
+            process.start()
+        logger.info(f"Started {self.shards} shard processes")
+        super().start_and_wait()
+        self.results_thread.start()
+
+    async def _decode_message(self, msg):
+        # one entry per message, complete once its shard reports it no matter how often it was delivered
+        key = self._message_key(msg)
+        self.acks.track_once(key, msg)
+        metrics.consumer_pending_acks.set(len(self.acks))
+        self._update_room()
+        shard = shard_for(msg.subject, self.shards)
+        headers = dict(msg.headers) if msg.headers else None
+        await self._enqueue(ShardMessage(msg.subject, msg.data, headers, key), self.inboxes[shard])
+        metrics.shard_inbox_depth.labels(shard=str(shard)).set(self.inboxes[shard].qsize())
+        return 1
+
+    def _read_results(self):
+        while self._running.is_set():
+            try:
+                _, keys = self.outbox.get(timeout=1)
+            except Empty:
+                continue
+            try:
+                self.rows_committed(keys)
+            except RuntimeError:
+                return  # event loop closed while shutting down, the rest is redelivered
+
+    def stop(self):
+        for inbox in self.inboxes:
+            inbox.put(None)  # poison pill, the shard finishes what it has queued and exits
+        # let the shards report their last commits before the loop stops acking
+        for process in self.processes:
+            process.join(timeout=10)
+        super().stop()
+
+
+# Runs in a shard process: the usual decode / last_seen logic, fed from the router instead of NATS
+class ShardConsumerThread(DefaultConsumerThread):
+    def __init__(self, config, queue, index, inbox, outbox):
+        super().__init__(config, queue)
+        self.index = index
+        self.inbox = inbox
+        self.outbox = outbox
+        # tracks messages until this shard's rows are committed, the router does the real acking
+        self.acks = AckTracker(ack_all=False)
+        self.reader = threading.Thread(target=self._read_inbox, name=f"shard-{index}-inbox", daemon=True)
+
+    async def _start(self):
+        self.reader.start()
+
+    def _message_key(self, msg):
+        return msg.seq
+
+    async def _decode_message(self, msg):
+        rows = await super()._decode_message(msg)
+        if rows is None:
+            # undecodable (already logged), it won't get any better on redelivery so let the router ack it
+            metrics.consumer_poison_rows_total.inc()
+            self.outbox.put(("committed", [msg.seq]))
+        return rows
+
+    def _read_inbox(self):
+        self._running.wait()
+        while self._running.is_set():
+            try:
+                msg = self.inbox.get(timeout=1)
+            except Empty:
+                continue
+            # take whatever else is already waiting, it's decoded as one batch
+            msgs = []
+            while msg is not None:
+                msgs.append(msg)
+                if len(msgs) >= self.fetch_batch:
+                    break
+                try:
+                    msg = self.inbox.get_nowait()
+                except Empty:
+                    break
+            if msgs:
+                # waits for the batch to be queued for the writer, a full writer queue stops reading
+                asyncio.run_coroutine_threadsafe(self._handle_batch(msgs), self.loop).result()
+            if msg is None:
+                logger.info(f"Shard {self.index} received shutdown signal")
+                self.stop()
+                return
+
+    async def _send_acks(self):
+        acks = self.acks.take_ready()
+        if acks:
+            self.outbox.put(("committed", [msg.seq for msg in acks]))
+        metrics.consumer_pending_acks.set(len(self.acks))
+
+
+def run_shard(config, index, inbox, outbox):
+    start_metrics_server(config, offset=index + 1)
+    event_queue = Queue(maxsize=config.get("writer", {}).get("queue_size", 10000))
+    consumer = ShardConsumerThread(config, event_queue, index, inbox, outbox)
+    db_writer = DBWriteThread(
+        queue=event_queue,
+        config=config,
+        on_commit=consumer.rows_committed,
+        on_failure=consumer.rows_failed
+    )
+    db_writer.start_and_wait()
+    consumer.start_and_wait()
+    logger.info(f"Shard {index} started")
+    consumer.join()
+    db_writer.stop()
+    db_writer.join(timeout=10)
+    logger.info(f"Shard {index} stopped")
@@ -3,8 +3,10 @@ import threading
 import time
 from utils.logging import setup_logger
 from config import load_config
+from utils.metrics import start_metrics_server
 from queue import Queue
 from consumer.defaultconsumer import DefaultConsumerThread
+from consumer.shardrouter import ShardRouterThread
 from writer.dbwritethread import DBWriteThread
 
 logger = setup_logger(__name__)
@@ -16,19 +18,32 @@ def main():
     for key, value in config.items():
         logger.info(f"  {key}: {value}")
 
+    start_metrics_server(config)
+
+    if config.get("consumer", {}).get("shards", 1) > 1:
+        run_sharded(config)
+        return
+
     # Create shared thread-safe queue consumers will place write-job's onto for 
-    # DBWriteThread to process (write to database)
-    event_queue = Queue()
+    # DBWriteThread to process (write to database). Bounded, consumers wait when it's full
+    event_queue = Queue(maxsize=config.get("writer", {}).get("queue_size", 10000))
+
+    # The consumer acks messages once the DB write thread reports their rows committed
+    default_consumer = DefaultConsumerThread(config=config, queue=event_queue)
+    default_consumer.daemon = True
 
     # Start DB write thread
-    db_writer = DBWriteThread(queue=event_queue)
+    db_writer = DBWriteThread(
+        queue=event_queue,
+        config=config,
+        on_commit=default_consumer.rows_committed,
+        on_failure=default_consumer.rows_failed
+    )
     db_writer.daemon = True
     db_writer.start_and_wait()
     logger.info(f"octopus DB write thread started ...")
     logger.info(f"octopus DB write thread started {db_writer.is_alive()}")
 
-    default_consumer = DefaultConsumerThread(config=config, queue=event_queue)
-    default_consumer.daemon = True
     default_consumer.start_and_wait()
     logger.info("default consumer started")
 
@@ -43,6 +58,21 @@ def main():
         db_writer.join()
         logger.info("Shutdown complete")
 
+def run_sharded(config):
+    # decoding and writing happen in the shard processes, this process only consumes and acks
+    router = ShardRouterThread(config=config)
+    router.start_and_wait()
+    logger.info(f"shard router started with {router.shards} shards")
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logger.info("Shutting down...")
+        router.stop()
+        router.join()
+        logger.info("Shutdown complete")
+
 if __name__ == "__main__":
     main()
 
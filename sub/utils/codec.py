@@ -0,0 +1,139 @@
+import struct
+from typing import List, Optional
+from utils.message import TelemetryMessage
+from utils.message import TelemetryBatchMessage
+from utils.message import decode_telemetry
+from utils.message import READING_FIELDS
+from utils.message import ENUM_FIELDS
+
+# Wire formats for telemetry payloads. The format is carried in the NATS "Content-Type" header so
+# JSON and binary producers/consumers can run side by side during a rollout. Payloads without the
+# header are sniffed: binary frames start with MAGIC, JSON always starts with "{".
+CONTENT_TYPE_HEADER = "Content-Type"
+JSON_CONTENT_TYPE = "application/json"
+BINARY_CONTENT_TYPE = "application/x-telemetry"
+
+# Binary frame, all integers big endian:
+#   magic (1B) | version (1B) | timestamp (int64) | source_mac (str) | source_ip (str) | count (uint16)
+#   then count readings of: field bitmap (uint16) | each present field in READING_FIELDS order
+# str is a uint8 length followed by utf-8 bytes, enums are their ordinal in declaration order
+# (only ever append new enum members), ints use the fixed widths in INT_FIELDS.
+# Version 2 added window_seconds (bitmap bit 13). Frames that don't use it are still written as
+# version 1 so consumers that only know version 1 keep working until aggregation is switched on.
+MAGIC = b"\xb7"
+VERSION = 2
+SUPPORTED_VERSIONS = {1: READING_FIELDS[:13], 2: READING_FIELDS}
+
+HEADER = struct.Struct(">cBq")
+COUNT = struct.Struct(">H")
+BITMAP = struct.Struct(">H")
+STR_LEN = struct.Struct(">B")
+ENUM = struct.Struct(">B")
+INT_FIELDS = {
+    "value": struct.Struct(">q"),
+    "data_field_index": struct.Struct(">H"),
+    "pieces": struct.Struct(">i"),
+    "estimated_pieces": struct.Struct(">i"),
+    "dry_time_seconds": struct.Struct(">i"),
+    "window_seconds": struct.Struct(">I"),
+}
+ENUM_MEMBERS = {name: list(enum_class) for name, enum_class in ENUM_FIELDS.items()}
+ENUM_ORDINALS = {name: {member: i for i, member in enumerate(members)} for name, members in ENUM_MEMBERS.items()}
+
+
+def _pack_str(value: str) -> bytes:
+    raw = value.encode("utf-8")
+    if len(raw) > 255:
+        raise ValueError(f"String field too long for binary frame: {value!r}")
+    return STR_LEN.pack(len(raw)) + raw
+
+
+def _unpack_str(data: bytes, offset: int):
+    (length,) = STR_LEN.unpack_from(data, offset)
+    offset += STR_LEN.size
+    return data[offset:offset + length].decode("utf-8"), offset + length
+
+
+def encode_binary(messages: List[TelemetryMessage]) -> bytes:
+    if not messages:
+        raise ValueError("Cannot encode an empty frame")
+    first = messages[0]
+    version = VERSION if any(msg.window_seconds is not None for msg in messages) else 1
+    parts = [
+        HEADER.pack(MAGIC, version, first.timestamp),
+        _pack_str(first.source_mac),
+        _pack_str(first.source_ip),
+        COUNT.pack(len(messages)),
+    ]
+    for msg in messages:
+        if (msg.timestamp, msg.source_mac, msg.source_ip) != (first.timestamp, first.source_mac, first.source_ip):
+            raise ValueError("All messages in a frame must share timestamp, source_mac and source_ip")
+        bitmap = 0
+        fields = []
+        for bit, name in enumerate(READING_FIELDS):
+            value = getattr(msg, name)
+            if value is None:
+                continue
+            bitmap |= 1 << bit
+            if name in ENUM_ORDINALS:
+                fields.append(ENUM.pack(ENUM_ORDINALS[name][value]))
+            elif name in INT_FIELDS:
+                fields.append(INT_FIELDS[name].pack(value))
+            else:
+                fields.append(_pack_str(value))
+        parts.append(BITMAP.pack(bitmap))
+        parts.extend(fields)
+    return b"".join(parts)
+
+
+def decode_binary(data: bytes) -> List[TelemetryMessage]:
+    magic, version, timestamp = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a binary telemetry frame")
+    if version not in SUPPORTED_VERSIONS:
+        raise ValueError(f"Unsupported binary telemetry version {version}")
+    reading_fields = SUPPORTED_VERSIONS[version]
+    offset = HEADER.size
+    source_mac, offset = _unpack_str(data, offset)
+    source_ip, offset = _unpack_str(data, offset)
+    (count,) = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+    messages = []
+    for _ in range(count):
+        (bitmap,) = BITMAP.unpack_from(data, offset)
+        offset += BITMAP.size
+        fields = {}
+        for bit, name in enumerate(reading_fields):
+            if not bitmap & (1 << bit):
+                continue
+            if name in ENUM_MEMBERS:
+                (ordinal,) = ENUM.unpack_from(data, offset)
+                offset += ENUM.size
+                members = ENUM_MEMBERS[name]
+                fields[name] = members[ordinal] if ordinal < len(members) else None
+            elif name in INT_FIELDS:
+                (fields[name],) = INT_FIELDS[name].unpack_from(data, offset)
+                offset += INT_FIELDS[name].size
+            else:
+                fields[name], offset = _unpack_str(data, offset)
+        messages.append(TelemetryMessage(timestamp=timestamp, source_mac=source_mac, source_ip=source_ip, **fields))
+    return messages
+
+
+def encode_payload(messages: List[TelemetryMessage], content_type: str = JSON_CONTENT_TYPE, batch: bool = True) -> List[bytes]:
+    # Returns the payloads to publish for one scrape: a single frame when batching, otherwise one per message
+    if content_type == BINARY_CONTENT_TYPE:
+        if batch:
+            return [encode_binary(messages)]
+        return [encode_binary([msg]) for msg in messages]
+    if content_type != JSON_CONTENT_TYPE:
+        raise ValueError(f"Unknown content type {content_type}")
+    if batch:
+        return [TelemetryBatchMessage.from_messages(messages).to_bytes()]
+    return [msg.to_bytes() for msg in messages]
+
+
+def decode_payload(data: bytes, content_type: Optional[str] = None) -> List[TelemetryMessage]:
+    if content_type == BINARY_CONTENT_TYPE or (content_type is None and data[:1] == MAGIC):
+        return decode_binary(data)
+    return decode_telemetry(data)
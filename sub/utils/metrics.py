@@ -0,0 +1,75 @@
+# utils/metrics.py
+# Prometheus metrics for the subscriber. Metrics are always recorded, the http endpoint is only
+# started when metrics_port is set in config.yaml.
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from utils.logging import setup_logger
+
+logger = setup_logger(__name__)
+
+writer_batch_seconds = Histogram(
+    "writer_batch_seconds",
+    "Time taken to write and commit one batch",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+writer_batch_rows = Histogram(
+    "writer_batch_rows",
+    "Rows written per batch",
+    buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000),
+)
+writer_rows_total = Counter(
+    "writer_rows_total",
+    "Rows committed to the general table",
+)
+writer_rows_per_second = Gauge(
+    "writer_rows_per_second",
+    "Rows committed per second over the last batch interval",
+)
+writer_failed_batches_total = Counter(
+    "writer_failed_batches_total",
+    "Batch writes that failed and were retried or dropped",
+)
+writer_dropped_rows_total = Counter(
+    "writer_dropped_rows_total",
+    "Rows dropped, either invalid or still failing after every retry",
+)
+
+consumer_pending_acks = Gauge(
+    "consumer_pending_acks",
+    "Messages received and waiting for their rows to be committed before they are acked",
+)
+consumer_acks_total = Counter(
+    "consumer_acks_total",
+    "Acks sent to JetStream, with AckAll one ack covers every earlier message",
+)
+consumer_poison_rows_total = Counter(
+    "consumer_poison_rows_total",
+    "Rows (or undecodable messages in a shard) that can never be written, their messages are acked without them",
+)
+consumer_fetch_batch_size = Histogram(
+    "consumer_fetch_batch_size",
+    "Messages returned per fetch in pull mode",
+    buckets=(1, 10, 25, 50, 100, 250, 500, 1000),
+)
+writer_queue_depth = Gauge(
+    "writer_queue_depth",
+    "Rows waiting in the queue between the consumer and the DB writer",
+)
+consumer_queue_blocked_seconds_total = Counter(
+    "consumer_queue_blocked_seconds_total",
+    "Time the consumer spent waiting for room in the full writer queue",
+)
+shard_inbox_depth = Gauge(
+    "shard_inbox_depth",
+    "Messages routed to a shard process and not picked up by it yet",
+    ["shard"],
+)
+
+
+def start_metrics_server(config: dict, offset: int = 0):
+    # shard processes serve their own metrics on metrics_port + shard index + 1
+    port = config.get("metrics_port")
+    if port is None:
+        return
+    port = int(port) + offset
+    start_http_server(port)
+    logger.info(f"Serving prometheus metrics on :{port}")